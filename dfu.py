@@ -0,0 +1,307 @@
+import asyncio
+import functools
+import os
+import re
+import subprocess
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+
+DfuDevice = namedtuple("DfuDevice", ["vid", "pid", "path", "alt", "name", "serial"])
+
+DFU_LIST_PATTERN = re.compile(
+    r'Found DFU: \[([0-9a-fA-F]{4}):([0-9a-fA-F]{4})\].*?'
+    r'path="([^"]*)", alt=(\d+), name="([^"]*)", serial="([^"]*)"'
+)
+
+MEMORY_SEGMENT_PATTERN = re.compile(r"/(0x[0-9a-fA-F]+)/([^/]+)")
+MEMORY_GROUP_PATTERN = re.compile(r"(\d+)\*(\d+)([ KM]?)([a-g])")
+UNIT_MULTIPLIERS = {"": 1, " ": 1, "K": 1024, "M": 1024 * 1024}
+
+DEFAULT_SECTOR_SIZE = 128 * 1024
+
+DFU_POLL_INITIAL = 0.05
+DFU_POLL_MAX = 0.5
+DFU_READY_TIMEOUT = 10.0
+DFU_LIST_TIMEOUT = 5.0
+DFU_TRANSFER_TIMEOUT = 300.0
+
+
+async def run_blocking(function, *args, **kwargs):
+    """Run a blocking call (serial I/O, file access) in the default executor."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+def dfu_util_command(*args, dfu_path=None):
+    """
+    Builds a dfu-util command line for alternate setting 0.
+
+    Parameters:
+      args (str): Extra dfu-util arguments, e.g. "-s", "0x08040000:leave".
+      dfu_path (str): USB bus-port path (e.g. '1-1.2') selecting one board when
+        several are in DFU mode at once, or None to let dfu-util pick.
+    """
+    cmd = ["dfu-util", "-a", "0"]
+    if dfu_path:
+        cmd += ["-p", dfu_path]
+    return cmd + list(args)
+
+
+async def list_dfu_devices_async():
+    """
+    Runs `dfu-util -l` and parses every interface it reports.
+
+    Returns:
+      A list of DfuDevice tuples; empty if nothing is in DFU mode or dfu-util
+      could not be run.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "dfu-util", "-l", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError as e:
+        print(f"Error listing DFU devices: {e}")
+        return []
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), DFU_LIST_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        print("Error listing DFU devices: dfu-util -l timed out")
+        return []
+    return parse_dfu_list(stdout.decode(errors="replace"))
+
+
+def parse_dfu_list(output):
+    """Parse the interfaces reported by `dfu-util -l` into DfuDevice tuples."""
+    devices = []
+    for match in DFU_LIST_PATTERN.finditer(output):
+        vid, pid, path, alt, name, serial = match.groups()
+        devices.append(DfuDevice(int(vid, 16), int(pid, 16), path, int(alt), name, serial))
+    return devices
+
+
+def find_dfuse_interface(devices, dfu_path=None):
+    """Pick the STM32 DfuSe flash interface of the expected board, or None."""
+    for device in devices:
+        # DfuSe interfaces describe their memory layout in a name starting with '@'
+        if device.alt == 0 and device.name.startswith("@") and dfu_path in (None, device.path):
+            return device
+    return None
+
+
+def memory_sectors(name):
+    """
+    Parses a DfuSe memory descriptor into its flash sectors.
+
+    The descriptor is the interface name reported by `dfu-util -l`, e.g.
+    '@Internal Flash   /0x08000000/16*128Kg'. Each group gives a sector count,
+    a sector size and an access type letter.
+
+    Parameters:
+      name (str): The DfuSe interface name.
+
+    Returns:
+      A list of (address, size) tuples, one per sector, in address order.
+    """
+    sectors = []
+    for start, groups in MEMORY_SEGMENT_PATTERN.findall(name):
+        address = int(start, 16)
+        for count, size, unit, _ in MEMORY_GROUP_PATTERN.findall(groups):
+            size = int(size) * UNIT_MULTIPLIERS[unit]
+            for _ in range(int(count)):
+                sectors.append((address, size))
+                address += size
+    return sectors
+
+
+def sector_span(sectors, address, length):
+    """
+    Finds the run of whole sectors covering [address, address + length).
+
+    Falls back to DEFAULT_SECTOR_SIZE alignment if the range is outside the
+    descriptor (or no descriptor was available).
+
+    Returns:
+      A tuple (start, size) of the covering region.
+    """
+    end = address + length
+    covering = [(start, size) for start, size in sectors if start < end and start + size > address]
+    if covering and covering[0][0] <= address and covering[-1][0] + covering[-1][1] >= end:
+        return covering[0][0], covering[-1][0] + covering[-1][1] - covering[0][0]
+    start = address - address % DEFAULT_SECTOR_SIZE
+    stop = -(-end // DEFAULT_SECTOR_SIZE) * DEFAULT_SECTOR_SIZE
+    return start, stop - start
+
+
+def image_sectors(sectors, address, length):
+    """
+    Splits the flash range an image occupies into sectors.
+
+    Parameters:
+      sectors (list): (address, size) tuples from memory_sectors; may be empty.
+      address (int): Flash address of the image.
+      length (int): Image length in bytes.
+
+    Returns:
+      A list of (address, size) tuples covering the image, falling back to
+      DEFAULT_SECTOR_SIZE alignment where the descriptor does not cover it.
+    """
+    covering = []
+    position = address
+    end = address + length
+    while position < end:
+        start, size = sector_span(sectors, position, 1)
+        covering.append((start, size))
+        position = start + size
+    return covering
+
+
+async def wait_for_dfu_device_async(dfu_path=None, timeout=DFU_READY_TIMEOUT):
+    """
+    Polls the DFU device list until the STM32 DfuSe flash interface shows up.
+
+    The poll interval starts short and backs off, so a fast bootloader is picked
+    up almost immediately while a slow USB stack still gets until the deadline.
+
+    Parameters:
+      dfu_path (str): USB bus-port path of the expected board, or None for any board.
+      timeout (float): Seconds to wait before giving up.
+
+    Returns:
+      The matching DfuDevice, or None if it did not appear in time.
+    """
+    deadline = time.monotonic() + timeout
+    delay = DFU_POLL_INITIAL
+    while True:
+        device = find_dfuse_interface(await list_dfu_devices_async(), dfu_path)
+        if device is not None:
+            return device
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, DFU_POLL_MAX)
+
+
+@contextmanager
+def image_handoff(data):
+    """
+    Exposes an in-memory image as a file path that dfu-util can read.
+
+    On Linux the image lives in an anonymous memfd that the child process
+    inherits and opens as /proc/self/fd/N; elsewhere it falls back to a private
+    file in /dev/shm or the system temp directory. Nothing is written next to
+    the firmware, so concurrent jobs never share a file.
+
+    Parameters:
+      data (bytes): The image contents, or a firmware_image.PatchedImage,
+        which is streamed into the file chunk by chunk.
+
+    Yields:
+      A tuple (path, pass_fds) to hand to dfu-util's -D and the subprocess.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("firmware")
+        try:
+            with open(fd, "wb", closefd=False) as f:
+                _write_image(f, data)
+            yield f"/proc/self/fd/{fd}", (fd,)
+        finally:
+            os.close(fd)
+        return
+
+    scratch_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, path = tempfile.mkstemp(suffix=".bin", dir=scratch_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            _write_image(f, data)
+        yield path, ()
+    finally:
+        os.remove(path)
+
+
+@asynccontextmanager
+async def image_handoff_async(data):
+    """Same as image_handoff, writing the image without blocking the event loop."""
+    with ExitStack() as stack:
+        yield await run_blocking(stack.enter_context, image_handoff(data))
+
+
+def _write_image(f, data):
+    if hasattr(data, "chunks"):
+        for chunk in data.chunks():
+            f.write(chunk)
+    else:
+        f.write(data)
+
+
+async def run_dfu_util_async(cmd, timeout=DFU_TRANSFER_TIMEOUT, pass_fds=()):
+    """
+    Runs a dfu-util command as an asyncio subprocess.
+
+    Parameters:
+      cmd (list): The command line, e.g. from dfu_util_command.
+      timeout (float): Seconds after which dfu-util is killed.
+      pass_fds (tuple): File descriptors the child process inherits.
+
+    Raises:
+      subprocess.CalledProcessError if dfu-util fails, or
+      subprocess.TimeoutExpired if it does not finish in time.
+    """
+    process = await asyncio.create_subprocess_exec(*cmd, pass_fds=pass_fds)
+    try:
+        returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+async def download_async(data, address, dfu_path=None, leave=True):
+    """
+    Writes an in-memory image to flash with dfu-util, without blocking the event loop.
+
+    dfu-util erases every sector the data touches before programming it.
+
+    Parameters:
+      data (bytes): The image contents, or a firmware_image.PatchedImage.
+      address (int): Flash address to write to.
+      dfu_path (str): USB bus-port path of the board, or None for any board.
+      leave (bool): Whether the board should leave DFU mode after this write.
+
+    Raises:
+      subprocess.CalledProcessError or subprocess.TimeoutExpired if dfu-util fails.
+    """
+    modifier = ":leave" if leave else ""
+    async with image_handoff_async(data) as (path, pass_fds):
+        await run_dfu_util_async(dfu_util_command(
+            "-s", f"0x{address:08x}{modifier}",
+            "-D", path,
+            dfu_path=dfu_path
+        ), pass_fds=pass_fds)
+
+
+async def upload_async(path, address, length, dfu_path=None, leave=False):
+    """
+    Reads a flash region back into a file with dfu-util, without blocking the event loop.
+
+    Parameters:
+      path (str): File to write; it must not exist yet.
+      address (int): Flash address to start reading at.
+      length (int): Number of bytes to read.
+      dfu_path (str): USB bus-port path of the board, or None for any board.
+      leave (bool): Whether the board should leave DFU mode after the read.
+
+    Raises:
+      subprocess.CalledProcessError or subprocess.TimeoutExpired if dfu-util fails.
+    """
+    modifier = ":leave" if leave else ""
+    await run_dfu_util_async(dfu_util_command(
+        "-s", f"0x{address:08x}:{length}{modifier}",
+        "-U", path,
+        dfu_path=dfu_path
+    ))
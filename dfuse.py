@@ -0,0 +1,143 @@
+import struct
+import zlib
+from collections import namedtuple
+
+DfuseElement = namedtuple("DfuseElement", ["address", "data"])
+DfuseTarget = namedtuple("DfuseTarget", ["alt", "name", "elements"])
+DfuseFile = namedtuple("DfuseFile", ["vid", "pid", "bcd_device", "targets"])
+
+ARDUINO_VID = 0x2341
+GIGA_DFU_PID = 0x0366
+
+PREFIX_FORMAT = "<5sBIB"
+TARGET_FORMAT = "<6sBI255sII"
+ELEMENT_FORMAT = "<II"
+SUFFIX_FORMAT = "<HHHH3sB"
+
+PREFIX_SIZE = struct.calcsize(PREFIX_FORMAT)
+TARGET_SIZE = struct.calcsize(TARGET_FORMAT)
+ELEMENT_SIZE = struct.calcsize(ELEMENT_FORMAT)
+SUFFIX_SIZE = struct.calcsize(SUFFIX_FORMAT) + 4
+
+BCD_DFUSE = 0x011A
+
+
+def dfu_crc(data):
+    """DFU suffix CRC: CRC-32 without the final inversion."""
+    return ~zlib.crc32(data) & 0xFFFFFFFF
+
+
+def build_dfuse(targets, vid=ARDUINO_VID, pid=GIGA_DFU_PID, bcd_device=0xFFFF):
+    """
+    Serializes a DfuSe (.dfu) file.
+
+    Parameters:
+      targets (list): DfuseTarget tuples, each holding DfuseElement tuples with
+        their flash address and raw image bytes.
+      vid, pid, bcd_device (int): USB identifiers written into the DFU suffix.
+
+    Returns:
+      The complete file contents, including the DFU suffix and CRC.
+    """
+    body = b""
+    for target in targets:
+        elements = b""
+        for element in target.elements:
+            elements += struct.pack(ELEMENT_FORMAT, element.address, len(element.data)) + element.data
+        name = target.name.encode("ascii")
+        body += struct.pack(
+            TARGET_FORMAT, b"Target", target.alt, 1 if name else 0, name, len(elements), len(target.elements)
+        )
+        body += elements
+
+    image_size = PREFIX_SIZE + len(body)
+    data = struct.pack(PREFIX_FORMAT, b"DfuSe", 0x01, image_size, len(targets)) + body
+    data += struct.pack(SUFFIX_FORMAT, bcd_device, pid, vid, BCD_DFUSE, b"UFD", 16)
+    return data + struct.pack("<I", dfu_crc(data))
+
+
+def parse_dfuse(data):
+    """
+    Parses and validates a DfuSe (.dfu) file.
+
+    Parameters:
+      data (bytes): The complete file contents.
+
+    Returns:
+      A DfuseFile tuple.
+
+    Raises:
+      ValueError if the signatures, sizes or CRC do not check out.
+    """
+    if len(data) < PREFIX_SIZE + SUFFIX_SIZE:
+        raise ValueError("File is too short to be a DfuSe image.")
+
+    (crc,) = struct.unpack_from("<I", data, len(data) - 4)
+    if crc != dfu_crc(data[:-4]):
+        raise ValueError("DFU suffix CRC mismatch.")
+    bcd_device, pid, vid, bcd_dfu, signature, length = struct.unpack_from(
+        SUFFIX_FORMAT, data, len(data) - SUFFIX_SIZE
+    )
+    if signature != b"UFD" or length != SUFFIX_SIZE or bcd_dfu != BCD_DFUSE:
+        raise ValueError("Missing or unsupported DFU suffix.")
+
+    signature, version, image_size, target_count = struct.unpack_from(PREFIX_FORMAT, data, 0)
+    if signature != b"DfuSe" or version != 0x01:
+        raise ValueError("Missing DfuSe prefix.")
+    if image_size != len(data) - SUFFIX_SIZE:
+        raise ValueError("DfuSe image size does not match the file size.")
+
+    offset = PREFIX_SIZE
+    targets = []
+    for _ in range(target_count):
+        if offset + TARGET_SIZE > image_size:
+            raise ValueError("Truncated DfuSe target prefix.")
+        signature, alt, named, name, target_size, element_count = struct.unpack_from(TARGET_FORMAT, data, offset)
+        if signature != b"Target":
+            raise ValueError(f"Bad target signature at offset {offset}.")
+        offset += TARGET_SIZE
+        end = offset + target_size
+        if end > image_size:
+            raise ValueError("DfuSe target runs past the end of the image.")
+        elements = []
+        for _ in range(element_count):
+            if offset + ELEMENT_SIZE > end:
+                raise ValueError("Truncated DfuSe element header.")
+            address, size = struct.unpack_from(ELEMENT_FORMAT, data, offset)
+            offset += ELEMENT_SIZE
+            if offset + size > end:
+                raise ValueError(f"DfuSe element at 0x{address:08x} runs past the end of its target.")
+            elements.append(DfuseElement(address, bytes(data[offset:offset + size])))
+            offset += size
+        if offset != end:
+            raise ValueError("DfuSe target size does not match its elements.")
+        name = name.rstrip(b"\x00").decode("ascii") if named else ""
+        targets.append(DfuseTarget(alt, name, elements))
+
+    if offset != image_size:
+        raise ValueError("Trailing data after the last DfuSe target.")
+    return DfuseFile(vid, pid, bcd_device, targets)
+
+
+def validate_dfuse(data, expected_elements=None):
+    """
+    Checks that a DfuSe file is well formed and, optionally, holds the given images.
+
+    Parameters:
+      data (bytes): The complete file contents.
+      expected_elements (list): DfuseElement tuples that must be present, or None.
+
+    Returns:
+      True if the file is valid, False otherwise.
+    """
+    try:
+        dfuse = parse_dfuse(data)
+    except ValueError as e:
+        print(f"Invalid DfuSe file: {e}")
+        return False
+    if expected_elements is not None:
+        elements = [element for target in dfuse.targets for element in target.elements]
+        if elements != list(expected_elements):
+            print("DfuSe file does not contain the expected images.")
+            return False
+    return True
@@ -0,0 +1,632 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SERIAL_MARKER = b'__SERIAL_NUMBER__'
+SERIAL_FIELD_LENGTH = 12
+
+M7_ADDRESS = 0x08040000
+M4_ADDRESS = 0x08100000
+
+# Flash window of each core's partition on the STM32H747, by start address
+PARTITION_ENDS = {M7_ADDRESS: 0x08100000, M4_ADDRESS: 0x08200000}
+# RAM the initial stack pointer can point into: DTCM, AXI SRAM, SRAM1-3 (also
+# at its M4 alias 0x10000000), SRAM4 and the GIGA's external SDRAM
+RAM_RANGES = [
+    (0x20000000, 0x20020000),
+    (0x24000000, 0x24080000),
+    (0x30000000, 0x30048000),
+    (0x10000000, 0x10048000),
+    (0x38000000, 0x38010000),
+    (0x60000000, 0x60800000),
+    (0xC0000000, 0xC0800000),
+]
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 3
+
+# What to do when a marker occurs more than once: refuse to patch, or patch every copy
+DUPLICATE_POLICIES = ("refuse", "all")
+
+# Linux ioctl that makes a file share another file's blocks (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 64 * 1024
+
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+# One marker-prefixed field to stamp into an image
+FieldSpec = namedtuple("FieldSpec", ["marker", "field_length", "value"])
+# One field found by scan_fields; offset is where the field starts, just past the marker
+FieldMatch = namedtuple("FieldMatch", ["marker", "offset", "value"])
+
+
+def select_fields(offsets, marker, duplicates="refuse"):
+    """
+    Applies the duplicate policy to the copies of a field found in an image.
+
+    If the linker emitted the marker twice, patching only the first copy can
+    leave the firmware reporting the stale one, so by default such images are
+    refused before anything is flashed.
+
+    Parameters:
+      offsets (list): Offsets of every copy of the field.
+      marker (bytes): The field's marker, for the error message.
+      duplicates (str): 'refuse' or 'all' (patch every copy).
+
+    Returns:
+      The offsets to patch.
+
+    Raises:
+      ValueError if the field occurs more than once and the policy is 'refuse'.
+    """
+    if len(offsets) > 1 and duplicates == "refuse":
+        listed = ", ".join(f"0x{offset:x}" for offset in offsets)
+        raise ValueError(f"{marker.decode('ascii')} occurs {len(offsets)} times (fields at {listed}); refusing to patch only one of them.")
+    return offsets
+
+
+def read_field(bin_path, marker=SERIAL_MARKER, field_length=SERIAL_FIELD_LENGTH):
+    """
+    Reads a marker-prefixed, NUL-padded field from a firmware binary.
+
+    The file is memory-mapped, so only the pages the search touches are read.
+
+    Parameters:
+      bin_path (str): Path to the binary firmware file.
+      marker (bytes): Marker that prefixes the field.
+      field_length (int): The fixed length allocated for the field.
+
+    Returns:
+      A tuple (value, offset) where value is the contents of the first copy of
+      the field as a string and offset is the byte offset of that field (just
+      past the marker), or (None, None) if the marker was not found.
+    """
+    if os.path.getsize(bin_path) == 0:
+        return None, None
+    with open(bin_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        starts = find_fields(mm, [marker]).get(marker)
+        if not starts:
+            return None, None
+        return mm[starts[0]:starts[0] + field_length].rstrip(b'\x00').decode("ascii"), starts[0]
+
+
+def patch_field(bin_path, value, marker=SERIAL_MARKER, field_length=SERIAL_FIELD_LENGTH, duplicates="refuse"):
+    """
+    Overwrites a marker-prefixed field of a firmware binary in place.
+
+    A single-field patch_fields: the file is memory-mapped and searched once,
+    and only the field itself is written, padded with NUL bytes to its fixed
+    length.
+
+    Parameters:
+      bin_path (str): Path to the binary firmware file.
+      value (str): The new field contents (e.g., 'DA_2025_123').
+      marker (bytes): Marker that prefixes the field.
+      field_length (int): The fixed length allocated for the field.
+      duplicates (str): What to do if the marker occurs more than once, see
+        select_fields.
+
+    Returns:
+      A tuple (offset, old_value) where offset is the byte offset of the
+      (first) field and old_value its previous contents, or (None, None) if
+      the marker was not found.
+
+    Raises:
+      ValueError if the value does not fit into the field, or the field occurs
+      more than once and duplicates is 'refuse'.
+    """
+    if os.path.getsize(bin_path) == 0:
+        return None, None
+    old_values = patch_fields(bin_path, [FieldSpec(marker, field_length, value)], duplicates, required=False)
+    return old_values.get(marker, (None, None))
+
+
+def encode_field(value, field_length=SERIAL_FIELD_LENGTH):
+    """
+    Encodes a field value, NUL-padded to the field's fixed length.
+
+    Raises:
+      ValueError if the value does not fit into the field.
+    """
+    encoded = value.encode("ascii")
+    if len(encoded) > field_length:
+        raise ValueError(f"'{value}' is longer than the {field_length}-byte field.")
+    return encoded.ljust(field_length, b'\x00')
+
+
+def field_spec(text):
+    """
+    Parses a field given on the command line as MARKER:LENGTH=VALUE.
+
+    Returns:
+      A FieldSpec.
+
+    Raises:
+      ValueError if the text is not in that format.
+    """
+    match = re.fullmatch(r"([^:=]+):(\d+)=(.*)", text)
+    if match is None:
+        raise ValueError(f"'{text}' is not of the form MARKER:LENGTH=VALUE.")
+    return FieldSpec(match.group(1).encode("ascii"), int(match.group(2)), match.group(3))
+
+
+def positive_int(text):
+    """Parses a count given on the command line (e.g. --workers) that must be at least 1."""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def find_fields(buffer, markers, offsets=None):
+    """
+    Locates several markers in a single pass over an image.
+
+    All markers are combined into one regular expression, so the image is
+    scanned once however many fields there are. Longer markers take precedence
+    over markers that are a prefix of them.
+
+    Known offsets must come from the manifest entry of this very image, which
+    indexes every copy of a field: a marker is not scanned for if any of its
+    known offsets still follows the marker, and the matching ones are trusted.
+    Board readbacks are not in the manifest and are always scanned in full.
+
+    Parameters:
+      buffer: The image (bytes, bytearray or mmap).
+      markers (list): The markers to look for.
+      offsets (dict): Known field offsets by marker, or None.
+
+    Returns:
+      A dict mapping each marker that was found to the offsets of its fields
+      (just past every occurrence of the marker).
+    """
+    found = {}
+    for marker, known in (offsets or {}).items():
+        starts = [offset for offset in known if offset >= len(marker) and buffer[offset - len(marker):offset] == marker]
+        if marker in markers and starts:
+            found[marker] = starts
+    remaining = sorted(set(markers) - set(found), key=len, reverse=True)
+    if remaining:
+        pattern = re.compile(b"|".join(re.escape(marker) for marker in remaining))
+        for match in pattern.finditer(buffer):
+            found.setdefault(match.group(), []).append(match.end())
+    return found
+
+
+def scan_fields(path, fields=((SERIAL_MARKER, SERIAL_FIELD_LENGTH),), chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Finds every occurrence of one or more marker-prefixed fields in a file.
+
+    The file is read in fixed-size chunks, and the last len(marker) +
+    field_length - 1 bytes of each chunk are carried over into the next one,
+    so fields straddling a chunk boundary are still found while memory use
+    stays the same whatever the size of the file. Suited to readback dumps,
+    which can be larger than the firmware image and hold stale copies of a
+    field.
+
+    Parameters:
+      path (str): The file to scan.
+      fields (list): (marker, field_length) tuples to look for.
+      chunk_size (int): Bytes read at a time.
+
+    Yields:
+      A FieldMatch per occurrence, in file order. A field cut off by the end of
+      the file is reported with what is there.
+    """
+    lengths = dict(fields)
+    overlap = max(len(marker) + length for marker, length in lengths.items()) - 1
+    pattern = re.compile(b"|".join(re.escape(marker) for marker in sorted(lengths, key=len, reverse=True)))
+    with open(path, "rb") as f:
+        buffer = b""
+        base = 0
+        reported = set()
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            for match in pattern.finditer(buffer):
+                position = base + match.start()
+                end = match.end() + lengths[match.group()]
+                if position in reported or (chunk and end > len(buffer)):
+                    continue
+                reported.add(position)
+                value = buffer[match.end():end].rstrip(b'\x00').decode("ascii", errors="replace")
+                yield FieldMatch(match.group(), base + match.end(), value)
+            if not chunk:
+                return
+            keep = min(overlap, len(buffer))
+            base += len(buffer) - keep
+            buffer = buffer[len(buffer) - keep:]
+            reported = {position for position in reported if position >= base}
+
+
+def field_overlays(buffer, specs, duplicates="refuse", offsets=None, required=True):
+    """
+    Works out the (offset, bytes) overlays that stamp several fields into an image.
+
+    Parameters:
+      buffer: The image (bytes, bytearray or mmap).
+      specs (list): FieldSpec tuples.
+      duplicates (str): What to do if a marker occurs more than once, see
+        select_fields.
+      offsets (dict): Known field offsets by marker from the image's manifest
+        entry, see find_fields.
+      required (bool): Whether a missing marker is an error; otherwise it is
+        left out of the result.
+
+    Returns:
+      A tuple (overlays, old_values): the list of (offset, bytes) overlays and a
+      dict mapping each marker to a tuple (offset, old_value) for its (first)
+      field.
+
+    Raises:
+      ValueError if a marker is missing (and required), given twice or occurs
+      more than once under the 'refuse' policy, a value does not fit into its
+      field or a field runs past the end of the image.
+    """
+    markers = [spec.marker for spec in specs]
+    if len(set(markers)) != len(markers):
+        raise ValueError("The same field is stamped more than once.")
+    found = find_fields(buffer, markers, offsets)
+    overlays = []
+    old_values = {}
+    for spec in specs:
+        if spec.marker not in found:
+            if required:
+                raise ValueError(f"No {spec.marker.decode('ascii')} field found in the firmware image.")
+            continue
+        starts = select_fields(found[spec.marker], spec.marker, duplicates)
+        if starts[-1] + spec.field_length > len(buffer):
+            raise ValueError(f"{spec.marker.decode('ascii')} field runs past the end of the firmware image.")
+        encoded = encode_field(spec.value, spec.field_length)
+        overlays.extend((start, encoded) for start in starts)
+        old_value = bytes(buffer[starts[0]:starts[0] + spec.field_length]).rstrip(b'\x00').decode("ascii", errors="replace")
+        old_values[spec.marker] = (starts[0], old_value)
+    return overlays, old_values
+
+
+def patch_fields(bin_path, specs, duplicates="refuse", required=True):
+    """
+    Overwrites several marker-prefixed fields of a firmware binary in place.
+
+    The file is memory-mapped and scanned once for all markers; nothing is
+    written unless every field was found and every value fits.
+
+    Parameters:
+      bin_path (str): Path to the binary firmware file.
+      specs (list): FieldSpec tuples.
+      duplicates (str): What to do if a marker occurs more than once, see
+        select_fields.
+      required (bool): Whether a missing marker is an error, see field_overlays.
+
+    Returns:
+      A dict mapping each marker that was found to a tuple (offset, old_value).
+
+    Raises:
+      ValueError if a marker is missing (and required), occurs more than once
+      under the 'refuse' policy, or a value does not fit into its field.
+    """
+    if os.path.getsize(bin_path) == 0:
+        raise ValueError(f"{bin_path} is empty.")
+    with open(bin_path, "r+b") as f, mmap.mmap(f.fileno(), 0) as mm:
+        overlays, old_values = field_overlays(mm, specs, duplicates, required=required)
+        for offset, data in overlays:
+            mm[offset:offset + len(data)] = data
+        mm.flush()
+    return old_values
+
+
+def clone_file(source, destination, size):
+    """
+    Copies a file without passing its contents through Python.
+
+    The copy shares the source's blocks (reflink) where the filesystem supports
+    it, and is otherwise copied inside the kernel with copy_file_range.
+
+    Parameters:
+      source (file): Open source file.
+      destination (file): Open, empty destination file.
+      size (int): Number of bytes to copy.
+
+    Returns:
+      True if the file was copied, False if the caller has to write it itself.
+    """
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError:
+            pass
+    if hasattr(os, "copy_file_range"):
+        copied = 0
+        try:
+            while copied < size:
+                count = os.copy_file_range(source.fileno(), destination.fileno(), size - copied, copied, copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+        if copied == size:
+            return True
+        destination.truncate(0)
+    return False
+
+
+def image_address(image_name):
+    """Return the flash address an image is written to, based on its file name."""
+    if image_name.startswith("firmwareM7"):
+        return M7_ADDRESS
+    if image_name.startswith("firmwareM4"):
+        return M4_ADDRESS
+    return None
+
+
+def image_problems(data, address, serial_offsets=None):
+    """
+    Checks that an image is plausible for the partition it is written to.
+
+    Looks at the Cortex-M vector table (initial stack pointer in RAM, reset
+    handler inside the partition and in Thumb mode), the image size and, for
+    the M4 image, the serial number field.
+
+    Parameters:
+      data (bytes): The image contents.
+      address (int): Flash address the image is written to (M7_ADDRESS or M4_ADDRESS).
+      serial_offsets (list): Offsets of the serial number fields, or None to
+        skip that check.
+
+    Returns:
+      A list of problem descriptions, empty if the image looks fine.
+    """
+    end = PARTITION_ENDS.get(address)
+    if end is None:
+        return [f"0x{address:08x} is not the start of a flash partition."]
+    if len(data) < 8:
+        return [f"Image is only {len(data)} bytes long."]
+    problems = []
+    if address + len(data) > end:
+        problems.append(f"Image is {len(data)} bytes, but the partition at 0x{address:08x} only holds {end - address}.")
+    stack_pointer, reset_vector = struct.unpack_from("<II", data)
+    if not any(start < stack_pointer <= ram_end for start, ram_end in RAM_RANGES):
+        problems.append(f"Initial stack pointer 0x{stack_pointer:08x} is not in RAM.")
+    if not address <= (reset_vector & ~1) < min(address + len(data), end):
+        problems.append(f"Reset vector 0x{reset_vector:08x} is outside the image.")
+    elif not reset_vector & 1:
+        problems.append(f"Reset vector 0x{reset_vector:08x} is not a Thumb address.")
+    if serial_offsets is not None and not serial_offsets:
+        problems.append("Serial number marker not found.")
+    return problems
+
+
+def describe_image(bin_path):
+    """
+    Computes the manifest entry for one firmware image.
+
+    Returns:
+      A dict with the image's size, mtime, SHA-256, flash address, the offsets
+      of every copy of its serial number field (empty if it has none) and the
+      problems found by image_problems (None if the address is unknown).
+    """
+    stat = os.stat(bin_path)
+    with open(bin_path, "rb") as f:
+        data = f.read()
+    address = image_address(os.path.basename(bin_path))
+    serial_offsets = find_fields(data, [SERIAL_MARKER]).get(SERIAL_MARKER, [])
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "address": address,
+        "serial_offsets": serial_offsets,
+        "problems": image_problems(data, address, serial_offsets if address == M4_ADDRESS else None) if address is not None else None,
+    }
+
+
+def load_manifest(firmware_dir):
+    """
+    Loads firmware/manifest.json, refreshing entries for images that changed.
+
+    An entry is trusted as long as the image's size and mtime match what was
+    recorded, so only new or modified images are hashed and scanned. The
+    manifest is rewritten only when something changed.
+
+    Parameters:
+      firmware_dir (str): Directory holding the firmware .bin files.
+
+    Returns:
+      A dict mapping image file names to their manifest entries.
+    """
+    manifest_path = os.path.join(firmware_dir, MANIFEST_NAME)
+    images = {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            images = manifest.get("images", {})
+    except (OSError, ValueError):
+        pass
+
+    names = sorted(name for name in os.listdir(firmware_dir) if name.endswith(".bin"))
+    changed = set(images) != set(names)
+    fresh = {}
+    for name in names:
+        path = os.path.join(firmware_dir, name)
+        stat = os.stat(path)
+        entry = images.get(name)
+        if entry is None or entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+            entry = describe_image(path)
+            changed = True
+        fresh[name] = entry
+
+    if changed:
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=firmware_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": MANIFEST_VERSION, "images": fresh}, f, indent=2, sort_keys=True)
+            os.replace(temp_path, manifest_path)
+        except OSError as e:
+            print(f"Could not write firmware manifest: {e}")
+    return fresh
+
+
+def manifest_entry(bin_path):
+    """Return the manifest entry for one image, or None if it is not a .bin file."""
+    return load_manifest(os.path.dirname(os.path.abspath(bin_path))).get(os.path.basename(bin_path))
+
+
+def validate_image(bin_path):
+    """
+    Pre-flight check of a firmware image, before any board is reset into DFU mode.
+
+    The result of image_problems is kept in the manifest with the image's hash,
+    so an image is only checked again after it changed.
+
+    Returns:
+      True if the image looks fine, False otherwise (the problems are printed).
+    """
+    entry = manifest_entry(bin_path)
+    if entry is None:
+        print(f"Error: {bin_path} is not a firmware image.")
+        return False
+    for problem in entry["problems"] or ():
+        print(f"Error: {os.path.basename(bin_path)}: {problem}")
+    return not entry["problems"]
+
+
+class PatchedImage:
+    """
+    A patched firmware image kept as its base file plus (offset, bytes) overlays.
+
+    Only the overlays live in memory; the patched contents are produced chunk
+    by chunk from the base file whenever they are read, hashed or handed to
+    dfu-util. Slicing (image[start:end]) reads just that range.
+    """
+
+    def __init__(self, base_path, overlays=()):
+        stat = os.stat(base_path)
+        self.base_path = base_path
+        self.size = stat.st_size
+        self.base_mtime_ns = stat.st_mtime_ns
+        self.overlays = sorted((offset, bytes(data)) for offset, data in overlays)
+        self.digest = None
+        for offset, data in self.overlays:
+            if offset < 0 or offset + len(data) > self.size:
+                raise ValueError(f"Overlay at offset 0x{offset:x} runs past the end of {base_path}")
+
+    @classmethod
+    def for_fields(cls, bin_path, specs, duplicates="refuse"):
+        """
+        Describes a copy of a firmware image with one or more fields stamped in.
+
+        The serial number offsets recorded in the manifest are checked against
+        the marker, so the image is only scanned for it if they are unknown or
+        stale; other markers are found in the same single pass.
+
+        Raises:
+          ValueError if a marker is missing, occurs more than once under the
+          'refuse' policy, or a value does not fit into its field.
+        """
+        entry = manifest_entry(bin_path)
+        offsets = {SERIAL_MARKER: entry["serial_offsets"]} if entry else None
+        with open(bin_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            overlays, old_values = field_overlays(mm, specs, duplicates, offsets)
+        for spec in specs:
+            offset, old_value = old_values[spec.marker]
+            print(f"Patched {spec.marker.decode('ascii')} {old_value} -> {spec.value} at offset 0x{offset:x}")
+        return cls(bin_path, overlays)
+
+    @classmethod
+    def from_deltas(cls, deltas_path, serial_number, base_path):
+        """
+        Loads one image from the delta records written by firmware_tool.py generate --deltas.
+
+        Raises:
+          ValueError if the records were written for another base image, hold
+          no such serial number, or the base image changed since they were
+          written.
+        """
+        with open(deltas_path) as f:
+            records = json.load(f)
+        if records["base"] != os.path.basename(base_path):
+            raise ValueError(f"{deltas_path} was written for {records['base']}, not {os.path.basename(base_path)}.")
+        entry = manifest_entry(base_path)
+        if entry is None or entry["sha256"] != records["sha256"]:
+            raise ValueError(f"{records['base']} changed since {deltas_path} was written.")
+        if serial_number not in records["overlays"]:
+            raise ValueError(f"No delta record for {serial_number} in {deltas_path}")
+        print(f"Using the serial number overlay for {serial_number} from {deltas_path}")
+        return cls(base_path, [(offset, bytes.fromhex(data)) for offset, data in records["overlays"][serial_number]])
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("PatchedImage only supports contiguous slices.")
+        start, end, _ = key.indices(self.size)
+        return b"".join(self.chunks(start, end))
+
+    def chunks(self, start=0, end=None, chunk_size=CHUNK_SIZE):
+        """
+        Yields the patched contents between two offsets, chunk by chunk.
+
+        Raises:
+          ValueError if the base image changed since this object was created.
+        """
+        end = self.size if end is None else min(end, self.size)
+        with open(self.base_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size != self.size or stat.st_mtime_ns != self.base_mtime_ns:
+                raise ValueError(f"{self.base_path} changed while it was being patched.")
+            f.seek(start)
+            position = start
+            while position < end:
+                chunk = f.read(min(chunk_size, end - position))
+                if not chunk:
+                    raise ValueError(f"{self.base_path} is shorter than expected.")
+                yield self._apply(chunk, position)
+                position += len(chunk)
+
+    def _apply(self, chunk, position):
+        end = position + len(chunk)
+        patched = None
+        for offset, data in self.overlays:
+            if offset >= end or offset + len(data) <= position:
+                continue
+            if patched is None:
+                patched = bytearray(chunk)
+            low, high = max(offset, position), min(offset + len(data), end)
+            patched[low - position:high - position] = data[low - offset:high - offset]
+        return chunk if patched is None else bytes(patched)
+
+    def read(self):
+        """Return the whole patched image as bytes."""
+        return self[:]
+
+    def sha256(self):
+        """Return the SHA-256 of the patched image, hashing it only once."""
+        if self.digest is None:
+            digest = hashlib.sha256()
+            for chunk in self.chunks():
+                digest.update(chunk)
+            self.digest = digest.hexdigest()
+        return self.digest
+
+
+def image_sha256(image):
+    """Return the SHA-256 of an image given as bytes or as a PatchedImage."""
+    if isinstance(image, PatchedImage):
+        return image.sha256()
+    return hashlib.sha256(image).hexdigest()
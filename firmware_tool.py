@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from firmware_image import DUPLICATE_POLICIES, SERIAL_FIELD_LENGTH, SERIAL_MARKER, clone_file, encode_field, manifest_entry, positive_int, scan_fields, select_fields
+
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "firmware")
+TARGETS = ["new_hardware", "old_hardware", "new_shield_old_dac_adc"]
+
+
+def serial_range(first, last):
+    """Return the full serial numbers DA_2025_{first} through DA_2025_{last}."""
+    return [f"DA_2025_{number:03d}" for number in range(first, last + 1)]
+
+
+def serial_fields(base_path, duplicates="refuse"):
+    """
+    Looks up the serial number fields to patch in a base image, using the firmware manifest.
+
+    Returns:
+      A tuple (entry, offsets) of the image's manifest entry and the field offsets.
+
+    Raises:
+      ValueError if the image has no serial number field, or more than one and
+      duplicates is 'refuse'.
+    """
+    entry = manifest_entry(base_path)
+    if entry is None or not entry["serial_offsets"]:
+        raise ValueError(f"No serial number field found in {base_path}")
+    return entry, select_fields(entry["serial_offsets"], SERIAL_MARKER, duplicates)
+
+
+def generate_images(base_path, serial_numbers, output_dir, workers=None, duplicates="refuse"):
+    """
+    Writes one serial-patched copy of a firmware image per serial number.
+
+    The base image is read once. Each copy is cloned from it (sharing its
+    blocks where the filesystem supports reflinks), and only the 12-byte
+    serial field is written on top.
+
+    Parameters:
+      base_path (str): The unpatched firmware image.
+      serial_numbers (list): Serial numbers to generate images for.
+      output_dir (str): Directory the images are written to.
+      workers (int): Number of images written in parallel, or None for one per CPU.
+      duplicates (str): 'refuse' or 'all', if the serial number field occurs
+        more than once.
+
+    Returns:
+      The number of images that were cloned rather than written out in full.
+
+    Raises:
+      ValueError if the image has no usable serial number field or a serial
+      number does not fit into it.
+    """
+    _, offsets = serial_fields(base_path, duplicates)
+    fields = {serial_number: encode_field(serial_number) for serial_number in serial_numbers}
+    with open(base_path, "rb") as f:
+        data = f.read()
+    name, extension = os.path.splitext(os.path.basename(base_path))
+    os.makedirs(output_dir, exist_ok=True)
+
+    def write_image(serial_number):
+        path = os.path.join(output_dir, f"{name}_{serial_number}{extension}")
+        with open(base_path, "rb") as source, open(path, "wb") as f:
+            cloned = clone_file(source, f, len(data))
+            if not cloned:
+                f.write(data)
+            for offset in offsets:
+                f.seek(offset)
+                f.write(fields[serial_number])
+        return cloned
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        return sum(executor.map(write_image, serial_numbers))
+
+
+def generate_deltas(base_path, serial_numbers, output_path, duplicates="refuse"):
+    """
+    Writes the patched images as delta records instead of full copies.
+
+    Each serial number maps to the (offset, bytes) overlays that turn the base
+    image into its patched image, so a whole production run fits in one small
+    JSON file next to the base image.
+
+    Raises:
+      ValueError if the image has no usable serial number field or a serial
+      number does not fit into it.
+    """
+    entry, offsets = serial_fields(base_path, duplicates)
+    records = {
+        "base": os.path.basename(base_path),
+        "sha256": entry["sha256"],
+        "overlays": {
+            serial_number: [[offset, encode_field(serial_number).hex()] for offset in offsets] for serial_number in serial_numbers
+        },
+    }
+    with open(output_path, "w") as f:
+        json.dump(records, f, indent=2, sort_keys=True)
+
+
+def generate(args):
+    if not 0 <= args.first <= args.last <= 999:
+        print("Error: Serial numbers must satisfy 0 <= first <= last <= 999.")
+        return False
+    base_path = os.path.join(FIRMWARE_DIR, f"firmwareM4_{args.target}.bin")
+    if not os.path.exists(base_path):
+        print(f"Error: Firmware file '{base_path}' not found.")
+        return False
+    serial_numbers = serial_range(args.first, args.last)
+    output_dir = args.output or os.path.join(FIRMWARE_DIR, "generated", args.target)
+
+    start = time.monotonic()
+    try:
+        if args.deltas:
+            os.makedirs(output_dir, exist_ok=True)
+            output = os.path.join(output_dir, f"firmwareM4_{args.target}_deltas.json")
+            generate_deltas(base_path, serial_numbers, output, args.duplicates)
+            print(f"Wrote delta records for {len(serial_numbers)} serial numbers to {output}")
+        else:
+            cloned = generate_images(base_path, serial_numbers, output_dir, args.workers, args.duplicates)
+            print(f"Wrote {len(serial_numbers)} images to {output_dir} ({cloned} cloned from the base image)")
+    except (OSError, ValueError) as e:
+        print(f"Error generating images: {e}")
+        return False
+    print(f"Took {time.monotonic() - start:.2f}s")
+    return True
+
+
+def marker_spec(text):
+    """Parses a field to scan for, given on the command line as MARKER:LENGTH."""
+    match = re.fullmatch(r"([^:]+):(\d+)", text)
+    if match is None:
+        raise ValueError(f"'{text}' is not of the form MARKER:LENGTH.")
+    return match.group(1).encode("ascii"), int(match.group(2))
+
+
+def dump_files(paths):
+    """Expand files and directories (searched recursively) into a sorted list of files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def scan_file(path, fields):
+    """Scan one dump, returning (path, matches) or (path, error message)."""
+    try:
+        return path, list(scan_fields(path, fields))
+    except OSError as e:
+        return path, str(e)
+
+
+def scan(args):
+    fields = args.field or [(SERIAL_MARKER, SERIAL_FIELD_LENGTH)]
+    files = dump_files(args.paths)
+    start = time.monotonic()
+    found = failed = 0
+    # Regex matching holds the GIL, so dumps are scanned in separate processes
+    with ProcessPoolExecutor(args.workers) as executor:
+        for path, matches in executor.map(scan_file, files, [fields] * len(files), chunksize=16):
+            if isinstance(matches, str):
+                print(f"{path}: {matches}")
+                failed += 1
+                continue
+            found += bool(matches)
+            for match in matches:
+                print(f"{path}: 0x{match.offset:08x} {match.marker.decode('ascii')} '{match.value}'")
+    print(f"Scanned {len(files)} files in {time.monotonic() - start:.2f}s: {found} with fields, {len(files) - found - failed} without, {failed} unreadable")
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline tools for GIGA firmware images.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser(
+        "generate",
+        help="Generate serial-patched M4 images for a range of serial numbers ahead of a production run"
+    )
+    generate_parser.add_argument("target", choices=TARGETS, help="The M4 firmware to patch.")
+    generate_parser.add_argument("first", type=int, nargs="?", default=0, help="First serial number (default 000).")
+    generate_parser.add_argument("last", type=int, nargs="?", default=999, help="Last serial number (default 999).")
+    generate_parser.add_argument(
+        "--output",
+        type=str,
+        help="Output directory; defaults to firmware/generated/{target}"
+    )
+    generate_parser.add_argument(
+        "--workers",
+        type=positive_int,
+        help="Number of images written in parallel; defaults to one per CPU"
+    )
+    generate_parser.add_argument(
+        "--deltas",
+        action="store_true",
+        help="Write one JSON file of per-serial overlays instead of full images"
+    )
+    generate_parser.add_argument(
+        "--duplicates",
+        choices=DUPLICATE_POLICIES,
+        default="refuse",
+        help="What to do if the serial number field occurs more than once: refuse, or patch every copy"
+    )
+    generate_parser.set_defaults(run=generate)
+
+    scan_parser = commands.add_parser(
+        "scan",
+        help="List every serial number field (or other marker-prefixed field) in readback dumps"
+    )
+    scan_parser.add_argument("paths", nargs="+", help="Dump files, or directories searched recursively.")
+    scan_parser.add_argument(
+        "--field",
+        type=marker_spec,
+        action="append",
+        metavar="MARKER:LENGTH",
+        help="Field to look for instead of the serial number (e.g. __CAL_ID__:8); may be repeated"
+    )
+    scan_parser.add_argument(
+        "--workers",
+        type=positive_int,
+        help="Number of dumps scanned in parallel; defaults to one per CPU"
+    )
+    scan_parser.set_defaults(run=scan)
+
+    args = parser.parse_args()
+    if not args.run(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
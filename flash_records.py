@@ -0,0 +1,102 @@
+import hashlib
+import os
+
+from firmware_image import image_sha256
+from workspace import read_state, update_state
+
+RECORDS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "state", "flash_records.json")
+
+
+def sector_hashes(data, address, sectors):
+    """
+    Hashes an image sector by sector.
+
+    Parameters:
+      data (bytes): The image contents, or a firmware_image.PatchedImage.
+      address (int): Flash address of the image.
+      sectors (list): (address, size) tuples covering the image, from dfu.image_sectors.
+
+    Returns:
+      A list of [address, size, sha256] entries, one per sector.
+    """
+    hashes = []
+    for start, size in sectors:
+        chunk = data[max(start - address, 0):start + size - address]
+        hashes.append([start, size, hashlib.sha256(chunk).hexdigest()])
+    return hashes
+
+
+def make_record(data, address, sectors):
+    """Build the record of an image that was just flashed at an address."""
+    return {
+        "address": address,
+        "size": len(data),
+        "sha256": image_sha256(data),
+        "sectors": sector_hashes(data, address, sectors),
+    }
+
+
+def changed_runs(record, previous):
+    """
+    Compares two flash records sector by sector.
+
+    Parameters:
+      record (dict): Record of the image about to be flashed.
+      previous (dict): Record of what was last flashed to the same core, or None.
+
+    Returns:
+      A list of (address, length) runs of consecutive sectors that differ, or None
+      if the records cannot be compared (no previous record or another sector layout).
+    """
+    if previous is None or previous["address"] != record["address"]:
+        return None
+    old = {start: (size, digest) for start, size, digest in previous["sectors"]}
+    runs = []
+    for start, size, digest in record["sectors"]:
+        if start not in old or old[start][0] != size:
+            return None
+        if old[start][1] == digest:
+            continue
+        if runs and runs[-1][0] + runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], runs[-1][1] + size)
+        else:
+            runs.append((start, size))
+    return runs
+
+
+def load_record(usb_serial, core):
+    """
+    Returns what was last flashed to one core of a board, or None if unknown.
+
+    Parameters:
+      usb_serial (str): USB serial number of the board.
+      core (str): 'M7' or 'M4'.
+    """
+    if not usb_serial:
+        return None
+    return read_state(RECORDS_PATH).get(usb_serial, {}).get(core)
+
+
+def save_record(usb_serial, core, record):
+    """
+    Stores what was just flashed to one core of a board.
+
+    Parameters:
+      usb_serial (str): USB serial number of the board; nothing is stored without it.
+      core (str): 'M7' or 'M4'.
+      record (dict): Record from make_record.
+    """
+    if not usb_serial:
+        return
+
+    def store(records):
+        records.setdefault(usb_serial, {})[core] = record
+
+    update_state(RECORDS_PATH, store)
+
+
+def forget_record(usb_serial, core):
+    """Drop the record of one core, e.g. after its flash turned out not to match it."""
+    if not usb_serial:
+        return
+    update_state(RECORDS_PATH, lambda records: records.get(usb_serial, {}).pop(core, None))
@@ -0,0 +1,219 @@
+import asyncio
+import re
+import time
+
+import serial
+import serial.tools.list_ports
+
+from dfu import run_blocking, wait_for_dfu_device_async
+
+APP_BAUD_RATE = 115200
+APP_READY_TIMEOUT = 15.0
+APP_POLL_INTERVAL = 0.05
+APP_HANDSHAKE_TIMEOUT = 0.25
+
+
+def natural_key(text):
+    """Sort key that orders the numbers in a string by value, so '1-1.10' comes after '1-1.2'."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", text or "")]
+
+
+def board_order(port):
+    """
+    Sort key for boards: by USB location, which stays the same when a board
+    re-enumerates, unlike its port name. Boards without a location come last.
+    """
+    return (port.location is None, natural_key(port.location), natural_key(port.device))
+
+
+def find_giga_ports():
+    """
+    Locate every connected Arduino GIGA based on its description and manufacturer.
+
+    Returns:
+      A list of pyserial ListPortInfo objects, ordered by USB location (see board_order).
+    """
+    ports = serial.tools.list_ports.comports()
+    boards = []
+    for port in ports:
+        if port.description and port.manufacturer:
+            if "Giga" in port.description and "Arduino" in port.manufacturer:
+                boards.append(port)
+    return sorted(boards, key=board_order)
+
+
+def find_giga_port():
+    """Locate the first Arduino GIGA, returning its port name or None."""
+    boards = find_giga_ports()
+    if boards:
+        return boards[0].device
+    return None
+
+
+def find_port_by_location(location):
+    """
+    Find the port name of the GIGA plugged into a given USB location.
+
+    Port names can change when boards re-enumerate, the USB location does not.
+    """
+    for port in find_giga_ports():
+        if port.location == location:
+            return port.device
+    return None
+
+
+def usb_path(location):
+    """Convert a pyserial location (e.g. '1-1.2:1.0') to a dfu-util path ('1-1.2')."""
+    if not location:
+        return None
+    return location.split(":")[0]
+
+
+def usb_hub(location):
+    """
+    Identify the hub a board hangs off, from its pyserial location.
+
+    '1-1.2:1.0' is port 2 of the hub on '1-1'; a board on a root port ('1-2')
+    is grouped with everything else on bus '1'.
+    """
+    path = usb_path(location)
+    if not path:
+        return None
+    bus, _, ports = path.partition("-")
+    if "." in ports:
+        return f"{bus}-{ports.rsplit('.', 1)[0]}"
+    return bus
+
+
+def trigger_dfu_mode(port):
+    """
+    Trigger DFU mode by opening the serial port at 1200 baud.
+    This is a common trick on Arduino boards to signal a bootloader reset.
+    """
+    try:
+        with serial.Serial(port, 1200, timeout=1) as ser:
+            pass
+        print(f"Triggered DFU mode on port {port}.")
+    except Exception as e:
+        print(f"Error triggering DFU mode on port {port}: {e}")
+
+
+def enter_dfu_mode(port, dfu_path=None):
+    """Same as enter_dfu_mode_async, for callers outside an event loop."""
+    return asyncio.run(enter_dfu_mode_async(port, dfu_path))
+
+
+async def enter_dfu_mode_async(port, dfu_path=None):
+    """
+    Reset the board into its bootloader and wait until dfu-util can see it.
+
+    Returns:
+      The DfuDevice once the DFU interface is up, or None if it never appeared.
+    """
+    await run_blocking(trigger_dfu_mode, port)
+    device = await wait_for_dfu_device_async(dfu_path)
+    if device is None:
+        print(f"Error: {port} did not show up in DFU mode.")
+    return device
+
+
+def nop_handshake(port, timeout=APP_HANDSHAKE_TIMEOUT):
+    """Send a single NOP and report whether the firmware echoed it back."""
+    try:
+        with serial.Serial(port, APP_BAUD_RATE, timeout=timeout) as ser:
+            ser.reset_input_buffer()
+            ser.write("NOP\r\n".encode())
+            return ser.readline().decode(errors="replace").strip() == "NOP"
+    except (serial.SerialException, OSError):
+        return False
+
+
+def wait_for_application(location=None, timeout=APP_READY_TIMEOUT):
+    """Same as wait_for_application_async, for callers outside an event loop."""
+    return asyncio.run(wait_for_application_async(location, timeout))
+
+
+async def wait_for_application_async(location=None, timeout=APP_READY_TIMEOUT):
+    """
+    Wait for freshly flashed firmware to come back up and answer NOP.
+
+    The CDC port is looked up again on every attempt, since it disappears while
+    the board is in DFU mode and may come back under a different name.
+
+    Parameters:
+      location (str): pyserial USB location of the board, or None for any GIGA.
+      timeout (float): Seconds to wait before giving up.
+
+    Returns:
+      The port name of the responding board, or None if it did not answer in time.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        port = await run_blocking(find_port_by_location, location) if location else await run_blocking(find_giga_port)
+        if port is not None and await run_blocking(nop_handshake, port):
+            return port
+        await asyncio.sleep(APP_POLL_INTERVAL)
+    return None
+
+
+def query_identity(port, timeout=APP_HANDSHAKE_TIMEOUT * 4):
+    """
+    Ask running firmware for its identification and serial number.
+
+    Returns:
+      A tuple (idn, serial_number), or None if the board did not answer NOP.
+    """
+    try:
+        with serial.Serial(port, APP_BAUD_RATE, timeout=timeout) as ser:
+            ser.reset_input_buffer()
+            ser.write("NOP\r\n".encode())
+            if ser.readline().decode(errors="replace").strip() != "NOP":
+                return None
+            ser.write("*IDN?\r\n".encode())
+            idn = ser.readline().decode(errors="replace").strip()
+            ser.write("SERIAL_NUMBER\r\n".encode())
+            serial_number = ser.readline().decode(errors="replace").strip()
+            return idn, serial_number
+    except (serial.SerialException, OSError):
+        return None
+
+
+def nop_test(port, expected_serial_number):
+    """
+    Check that the board answers NOP and reports the expected serial number.
+
+    Returns:
+      True if the firmware responded correctly, False otherwise.
+    """
+    try:
+        with serial.Serial(port, APP_BAUD_RATE, timeout=2) as ser:
+            print()
+            print(f"Testing NOP on {ser.port}...")
+
+            ser.write("NOP\r\n".encode())
+
+            response = ser.readline().decode().strip()
+
+            if response == "NOP":
+                print("NOP test passed: Correct response received.")
+            else:
+                print(f"NOP test failed: Expected 'nop', but received '{response}'")
+                return False
+
+            ser.write("*IDN?\r\n".encode())
+            id = ser.readline().decode().strip()
+
+            ser.write("SERIAL_NUMBER\r\n".encode())
+            serial_number = ser.readline().decode().strip()
+
+            print()
+            print(f"ID: {id}, Serial Number: {serial_number}")
+            if serial_number != expected_serial_number:
+                print(f"Serial number mismatch: Expected {expected_serial_number}, but got {serial_number}")
+                return False
+            print(f"Firmware successfully uploaded.")
+            return True
+
+    except Exception as e:
+        print(f"Error during NOP test: {e}")
+        return False
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from workspace import read_state, update_state
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "firmware", "cache")
+INDEX_PATH = os.path.join(CACHE_DIR, "index.json")
+CACHE_LIMIT = 512 * 1024 * 1024
+
+
+def cache_key(kind, target, serial_number, *sources):
+    """
+    Name the cache entry for a patched artifact.
+
+    Parameters:
+      kind (str): Type of artifact, e.g. 'dfu' for a DfuSe bundle.
+      target (str): Firmware target the artifact was built for.
+      serial_number (str): Serial number patched into it.
+      sources (str): SHA-256 of every base image it was built from, and
+        anything else that went into it.
+
+    Returns:
+      The key, also used as the file name of the entry.
+    """
+    base = hashlib.sha256("\n".join(sources).encode("utf-8")).hexdigest()[:16]
+    extension = ".dfu" if kind == "dfu" else ".bin"
+    return f"{kind}_{target}_{serial_number}_{base}{extension}"
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lookup(key):
+    """
+    Finds a cached artifact and checks that it is intact.
+
+    An entry whose file is missing or no longer matches its recorded SHA-256
+    is dropped, so the caller rebuilds it.
+
+    Returns:
+      The path of the cached file, or None on a miss.
+    """
+    entry = read_state(INDEX_PATH).get(key)
+    if entry is None:
+        return None
+    path = os.path.join(CACHE_DIR, key)
+    try:
+        intact = _file_sha256(path) == entry["sha256"]
+    except OSError:
+        intact = False
+    if not intact:
+        print(f"Discarding corrupt cache entry {key}")
+        update_state(INDEX_PATH, lambda index: index.pop(key, None))
+        _remove(path)
+        return None
+
+    def touch(index):
+        if key in index:
+            index[key]["last_used"] = time.time()
+
+    update_state(INDEX_PATH, touch)
+    return path
+
+
+def store(key, data, limit=CACHE_LIMIT):
+    """
+    Adds an artifact to the cache, evicting the least recently used entries
+    until the cache fits into its size limit again.
+
+    Parameters:
+      key (str): Key from cache_key.
+      data (bytes): The artifact contents.
+      limit (int): Maximum total size of the cache in bytes.
+
+    Returns:
+      The path of the cached file.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, key)
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+    evicted = []
+
+    def add(index):
+        index[key] = {"size": len(data), "sha256": hashlib.sha256(data).hexdigest(), "last_used": time.time()}
+        total = sum(entry["size"] for entry in index.values())
+        for old_key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= limit:
+                break
+            if old_key == key:
+                continue
+            total -= index.pop(old_key)["size"]
+            evicted.append(old_key)
+
+    update_state(INDEX_PATH, add)
+    for old_key in evicted:
+        _remove(os.path.join(CACHE_DIR, old_key))
+    return path
+
+
+def cached(key, build):
+    """
+    Returns the path of a cached artifact, building it on a miss.
+
+    Parameters:
+      key (str): Key from cache_key.
+      build (callable): Called without arguments to produce the artifact's bytes.
+    """
+    path = lookup(key)
+    if path is None:
+        path = store(key, build())
+    return path
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,49 @@
+import os
+
+from workspace import read_state, update_state
+
+JOURNAL_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "state", "journal.json")
+
+
+def load_progress(usb_serial, job):
+    """
+    Returns the stages a previous, unfinished run completed for the same job.
+
+    Progress is only reused if the previous run wrote the same images with the
+    same settings; otherwise the board starts from the beginning.
+
+    Parameters:
+      usb_serial (str): USB serial number of the board.
+      job (dict): What this run will write (target, serial number, mode, image hashes).
+
+    Returns:
+      A set of completed stage names.
+    """
+    if not usb_serial:
+        return set()
+    entry = read_state(JOURNAL_PATH).get(usb_serial)
+    if entry is None or entry.get("job") != job:
+        return set()
+    return set(entry.get("completed", []))
+
+
+def record_stage(usb_serial, job, stage):
+    """Journal that a stage of a job finished on a board."""
+    if not usb_serial:
+        return
+
+    def mark(journal):
+        entry = journal.get(usb_serial)
+        if entry is None or entry.get("job") != job:
+            entry = journal[usb_serial] = {"job": job, "completed": []}
+        if stage not in entry["completed"]:
+            entry["completed"].append(stage)
+
+    update_state(JOURNAL_PATH, mark)
+
+
+def clear_progress(usb_serial):
+    """Forget a board's journal entry once every stage has completed."""
+    if not usb_serial:
+        return
+    update_state(JOURNAL_PATH, lambda journal: journal.pop(usb_serial, None))
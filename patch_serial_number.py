@@ -1,60 +1,80 @@
 #!/usr/bin/env python3
 import re
-import serial
-import serial.tools.list_ports
 import subprocess
-import time
 import argparse
 import os
 import sys
 
-SERIAL_MARKER = b'__SERIAL_NUMBER__'
-SERIAL_FIELD_LENGTH = 12
-
-DFU_ADDRESS_READ = "0x08100000:"
-DFU_ADDRESS_WRITE = "0x08100000:leave"
+from dfu import dfu_util_command, memory_sectors, sector_span
+from firmware_image import DUPLICATE_POLICIES, M4_ADDRESS, SERIAL_FIELD_LENGTH, SERIAL_MARKER, FieldSpec, field_spec, load_manifest, patch_field, patch_fields, read_field
+from flash_records import forget_record
+from giga import enter_dfu_mode, find_giga_ports, nop_test, usb_path, wait_for_application
+from journal import clear_progress
+from workspace import board_lock, job_workspace
 
 TEMP_FIRMWARE = "temp_firmware.bin"
+TEMP_SECTOR = "temp_sector.bin"
 
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "firmware")
 
-def find_giga_port():
-    """Locate the Arduino GIGA based on its description and manufacturer."""
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        if port.description and port.manufacturer:
-            if "Giga" in port.description and "Arduino" in port.manufacturer:
-                return port.device
-    return None
 
+def serial_field_offsets(target=None):
+    """
+    Looks up where the serial field sits in the M4 image, using the firmware manifest.
 
-def trigger_dfu_mode(port):
+    Parameters:
+      target (str): The M4 firmware target, or None to accept the offsets only if
+        every released M4 image agrees on them.
+
+    Returns:
+      The offsets of every copy of the field relative to the start of the M4
+      image, or None if unknown.
     """
-    Trigger DFU mode by opening the serial port at 1200 baud.
-    This is a common trick on Arduino boards to signal a bootloader reset.
+    if not os.path.isdir(FIRMWARE_DIR):
+        return None
+    manifest = load_manifest(FIRMWARE_DIR)
+    if target is not None:
+        entry = manifest.get(f"firmwareM4_{target}.bin")
+        return entry["serial_offsets"] if entry else None
+    layouts = {tuple(entry["serial_offsets"]) for entry in manifest.values() if entry["address"] == M4_ADDRESS}
+    return list(layouts.pop()) if len(layouts) == 1 else None
+
+
+def m4_image_length(target=None):
     """
-    try:
-        with serial.Serial(port, 1200, timeout=1) as ser:
-            pass
-        print(f"Triggered DFU mode on port {port}.")
-        time.sleep(2)
-    except Exception as e:
-        print(f"Error triggering DFU mode on port {port}: {e}")
+    Looks up how many bytes of the M4 region hold the application, using the firmware manifest.
 
+    Parameters:
+      target (str): The M4 firmware target, or None for the largest released M4 image.
 
-def read_firmware_from_board(output_path):
+    Returns:
+      The image length in bytes, or None if unknown.
+    """
+    if not os.path.isdir(FIRMWARE_DIR):
+        return None
+    sizes = [
+        entry["size"] for name, entry in load_manifest(FIRMWARE_DIR).items()
+        if entry["address"] == M4_ADDRESS and (target is None or name == f"firmwareM4_{target}.bin")
+    ]
+    return max(sizes) if sizes else None
+
+
+def read_firmware_from_board(output_path, dfu_path=None, address=M4_ADDRESS, length=None):
     """
     Uses dfu-util to download (read) the current M4 firmware from the device.
     
     Parameters:
       output_path (str): Temporary filename to store the firmware binary.
+      dfu_path (str): USB path of the board for dfu-util, or None for any board.
+      address (int): Flash address to start reading at.
+      length (int): Number of bytes to read, or None to read to the end of flash.
     """
     print("Reading current M4 firmware from board using dfu-util...")
-    cmd = [
-        "dfu-util",
-        "-a", "0",
-        "-s", DFU_ADDRESS_READ,
-        "-U", output_path
-    ]
+    cmd = dfu_util_command(
+        "-s", f"0x{address:08x}:{length if length is not None else ''}",
+        "-U", output_path,
+        dfu_path=dfu_path
+    )
     subprocess.run(cmd, check=True)
     print(f"Firmware successfully read and saved to '{output_path}'.")
 
@@ -76,111 +96,222 @@ def read_serial_from_file(bin_path, marker=SERIAL_MARKER, field_length=SERIAL_FI
         - serial_str is the serial number (string) or None if not found.
         - marker_index is the starting index of the marker, or None if not found.
     """
-    with open(bin_path, "rb") as f:
-        data = f.read()
-    index = data.find(marker)
-    if index == -1:
+    serial_str, serial_start = read_field(bin_path, marker, field_length)
+    if serial_str is None:
         print("Serial number marker not found in firmware!")
         return None, None
-    serial_start = index + len(marker)
-    serial_end = serial_start + field_length
-    serial_bytes = data[serial_start:serial_end]
-    serial_str = serial_bytes.rstrip(b'\x00').decode("ascii")
-    return serial_str, index
+    return serial_str, serial_start - len(marker)
 
 
-def update_serial_in_file(bin_path, new_serial, marker=SERIAL_MARKER, field_length=SERIAL_FIELD_LENGTH):
+def update_fields_in_file(bin_path, specs, duplicates="refuse"):
+    """
+    Stamps several marker-prefixed fields into the firmware binary at once.
+    
+    All markers are found in a single scan of the file and every field is then
+    overwritten in place, so stamping more fields does not cost more passes.
+    
+    Parameters:
+      bin_path (str): Path to the firmware binary file.
+      specs (list): FieldSpec tuples (marker, field length, new value).
+      duplicates (str): 'refuse' to leave the file alone if a marker occurs more
+        than once, 'all' to patch every copy.
+    
+    Returns:
+      True if every field was patched, False otherwise (the file is then unchanged).
+    """
+    try:
+        results = patch_fields(bin_path, specs, duplicates)
+    except ValueError as e:
+        print(f"Cannot patch firmware: {e}")
+        return False
+    for spec in specs:
+        offset, old_value = results[spec.marker]
+        print(f"{spec.marker.decode('ascii')} updated from '{old_value}' to '{spec.value}' at offset 0x{offset:x}.")
+    return True
+
+
+def update_serial_in_file(bin_path, new_serial, marker=SERIAL_MARKER, field_length=SERIAL_FIELD_LENGTH, fields=(), duplicates="refuse"):
     """
     Replaces the serial number in the firmware binary with the new serial number.
     
-    The serial number field is updated in place: the new serial number (prepended with the marker)
-    is padded with NUL bytes to maintain the same length.
+    The serial number field (and any further fields) is updated in place through a
+    memory map: only the field after the marker is overwritten, padded with NUL bytes
+    to maintain the same length.
     
     Parameters:
       bin_path (str): Path to the firmware binary file.
       new_serial (str): The new serial number string (e.g., 'DA_2025_123').
       marker (bytes): Marker that prefixes the serial number in the binary.
       field_length (int): Fixed length for the serial number field.
+      fields (list): Further FieldSpec tuples to stamp in the same pass.
+      duplicates (str): 'refuse' to leave the file alone if a marker occurs more
+        than once, 'all' to patch every copy.
     
     Returns:
       True if patching was successful, False otherwise.
     """
-    with open(bin_path, "rb") as f:
-        data = f.read()
+    # A readback may hold copies of the field that no released image has, so it
+    # is always scanned in full rather than trusting the manifest offsets
+    return update_fields_in_file(bin_path, [FieldSpec(marker, field_length, new_serial), *fields], duplicates)
 
-    current_serial, marker_index = read_serial_from_file(bin_path, marker, field_length)
-    if current_serial is None:
-        print("No serial number found to update in firmware!")
-        return False
+
+def flash_firmware_to_board(firmware_path, dfu_path=None, address=M4_ADDRESS):
+    """
+    Uses dfu-util to flash the firmware binary back to the M4.
     
-    print(f"Current serial number in firmware: '{current_serial}'")
+    Only the flash sectors the file covers are erased and rewritten.
+    
+    Parameters:
+      firmware_path (str): Path to the firmware file to flash.
+      dfu_path (str): USB path of the board for dfu-util, or None for any board.
+      address (int): Flash address to write the file to.
+    """
+    print("Flashing updated firmware back to the board...")
+    cmd = dfu_util_command(
+        "-s", f"0x{address:08x}:leave",
+        "-D", firmware_path,
+        dfu_path=dfu_path
+    )
+    subprocess.run(cmd, check=True)
+    print("Firmware flashed successfully.")
 
-    old_serial_field = marker + current_serial.encode("ascii")
-    old_serial_field = old_serial_field.ljust(len(marker) + field_length, b'\x00')
 
-    new_serial_field = marker + new_serial.encode("ascii")
-    new_serial_field = new_serial_field.ljust(len(marker) + field_length, b'\x00')
+def rewrite_serial_sector(device, serial_number, field_offset, scratch_path, dfu_path=None):
+    """
+    Rewrites only the flash sector(s) holding the serial number field.
 
-    if old_serial_field not in data:
-        print("Old serial field not found in the firmware data!")
+    Parameters:
+      device (DfuDevice): The board in DFU mode; its memory descriptor gives the sector layout.
+      serial_number (str): The full serial number (e.g., 'DA_2025_123').
+      field_offset (int): Offset of the serial field in the M4 image.
+      scratch_path (str): Scratch path for the sector readback; must not exist yet.
+      dfu_path (str): USB path of the board for dfu-util, or None for any board.
+
+    Returns:
+      True if the sector was patched and flashed, False if dfu-util failed, or None
+      if the field was not found in the sector, e.g. because the board runs a
+      different build than the manifest describes.
+    """
+    field_address = M4_ADDRESS + field_offset - len(SERIAL_MARKER)
+    start, length = sector_span(memory_sectors(device.name), field_address, len(SERIAL_MARKER) + SERIAL_FIELD_LENGTH)
+    print(f"Rewriting only the {length // 1024} KiB of flash at 0x{start:08x} that hold the serial number.")
+
+    try:
+        read_firmware_from_board(scratch_path, dfu_path, start, length)
+    except subprocess.CalledProcessError as e:
+        print(f"Error reading firmware: {e}")
         return False
 
-    new_data = data.replace(old_serial_field, new_serial_field, 1)
-    with open(bin_path, "wb") as f:
-        f.write(new_data)
-    print(f"Firmware serial number updated to '{new_serial}'.")
+    try:
+        offset, current_serial = patch_field(scratch_path, serial_number)
+    except ValueError as e:
+        print(f"Cannot patch serial number: {e}")
+        return False
+    if offset is None:
+        print("Serial number field not found where expected; falling back to the full image.")
+        return None
+    print(f"Previous serial number in firmware: '{current_serial}'")
+
+    try:
+        flash_firmware_to_board(scratch_path, dfu_path, start)
+    except subprocess.CalledProcessError as e:
+        print(f"Error flashing firmware: {e}")
+        return False
     return True
 
 
-def flash_firmware_to_board(firmware_path):
+def rewrite_full_image(serial_number, temp_firmware, dfu_path=None, length=None, fields=(), duplicates="refuse"):
     """
-    Uses dfu-util to flash the firmware binary back to the M4.
-    
+    Reads back the M4 image, patches the serial number and flashes it back.
+
     Parameters:
-      firmware_path (str): Path to the firmware file to flash.
+      serial_number (str): The full serial number (e.g., 'DA_2025_123').
+      temp_firmware (str): Scratch path for the readback; must not exist yet.
+      dfu_path (str): USB path of the board for dfu-util, or None for any board.
+      length (int): Bytes to read back, or None to dump the whole M4 region.
+        Must cover whole sectors, since every sector written back is erased first.
+      fields (list): Further FieldSpec tuples to stamp along with the serial number.
+      duplicates (str): 'refuse' or 'all', for markers that occur more than once.
+
+    Returns:
+      True if the firmware was patched and flashed, False otherwise.
     """
-    print("Flashing updated firmware back to the board...")
-    cmd = [
-        "dfu-util",
-        "-a", "0",
-        "-s", DFU_ADDRESS_WRITE,
-        "-D", firmware_path
-    ]
-    subprocess.run(cmd, check=True)
-    print("Firmware flashed successfully.")
+    try:
+        read_firmware_from_board(temp_firmware, dfu_path, length=length)
+    except subprocess.CalledProcessError as e:
+        print(f"Error reading firmware: {e}")
+        return False
 
+    current_serial, _ = read_serial_from_file(temp_firmware)
+    if current_serial:
+        print(f"Firmware currently contains serial number: '{current_serial}'")
+    else:
+        print("No serial number found in firmware; proceeding with update anyway.")
+ 
+    if not update_serial_in_file(temp_firmware, serial_number, fields=fields, duplicates=duplicates):
+        print("Failed to update the serial number in firmware.")
+        return False
 
-def nop_test(port, expected_serial_number):
-  try:
-      with serial.Serial(port, 115200, timeout=2) as ser:
-          print()
-          print(f"Testing NOP on {ser.port}...")
-          
-          ser.write("NOP\r\n".encode())
-          
-          response = ser.readline().decode().strip()
-          
-          if response == "NOP":
-              print("NOP test passed: Correct response received.")
-          else:
-              print(f"NOP test failed: Expected 'nop', but received '{response}'")
-              return
-          
-          ser.write("*IDN?\r\n".encode())
-          id = ser.readline().decode().strip()
-          
-          ser.write("SERIAL_NUMBER\r\n".encode())
-          serial_number = ser.readline().decode().strip()
-          
-          print()
-          print(f"ID: {id}, Serial Number: {serial_number}")
-          if serial_number != expected_serial_number:
-              print(f"Serial number mismatch: Expected {expected_serial_number}, but got {serial_number}")
-              return
-          print(f"Firmware successfully uploaded.")
-          
-  except Exception as e:
-      print(f"Error during NOP test: {e}")
+    try:
+        flash_firmware_to_board(temp_firmware, dfu_path)
+    except subprocess.CalledProcessError as e:
+        print(f"Error flashing firmware: {e}")
+        return False
+    return True
+
+
+def reserialize_board(board, serial_number, workdir, field_offset=None, image_length=None, fields=(), duplicates="refuse"):
+    """
+    Reads back the M4 firmware of one board, patches its serial number and flashes it.
+
+    With a known field offset only the sector holding the serial number is read
+    and rewritten; otherwise the whole M4 region is.
+
+    Parameters:
+      board: pyserial ListPortInfo of the board.
+      serial_number (str): The full serial number (e.g., 'DA_2025_123').
+      workdir (str): Private scratch directory for the readback.
+      field_offset (int): Offset of the serial field in the M4 image, or None if unknown.
+      image_length (int): Length of the M4 image, or None to read back the whole M4 region.
+      fields (list): Further FieldSpec tuples to stamp; these may sit anywhere in
+        the image, so the whole image is rewritten.
+      duplicates (str): 'refuse' or 'all', for markers that occur more than once.
+
+    Returns:
+      True if the board was flashed and answered with the new serial number.
+    """
+    port = board.device
+    dfu_path = usb_path(board.location)
+
+    device = enter_dfu_mode(port, dfu_path)
+    if not device:
+        return False
+
+    # The M4 flash no longer matches what upload_firmware.py last wrote, so
+    # neither its record (used by --diff and to skip unchanged cores) nor an
+    # interrupted upload's journal may be trusted afterwards
+    forget_record(board.serial_number, "M4")
+    clear_progress(board.serial_number)
+
+    flashed = None
+    if field_offset is not None and not fields:
+        flashed = rewrite_serial_sector(device, serial_number, field_offset, os.path.join(workdir, TEMP_SECTOR), dfu_path)
+        if flashed is False:
+            return False
+    if flashed is None:
+        length = None
+        if image_length is not None:
+            # Round up to whole sectors so nothing past the image is erased without being rewritten
+            length = sector_span(memory_sectors(device.name), M4_ADDRESS, image_length)[1]
+        if not rewrite_full_image(serial_number, os.path.join(workdir, TEMP_FIRMWARE), dfu_path, length, fields, duplicates):
+            return False
+
+    print("Validating...")
+    port = wait_for_application(board.location)
+    if port is None:
+        print("Firmware did not come back up after flashing.")
+        return False
+    return nop_test(port, serial_number)
 
 
 def main():
@@ -192,6 +323,35 @@ def main():
         type=str,
         help="New serial number to patch into the firmware (format e.g., 123)"
     )
+    parser.add_argument(
+        "--port",
+        type=str,
+        help="Serial port of the board to patch; required when more than one GIGA is connected"
+    )
+    parser.add_argument(
+        "--target",
+        choices=["new_hardware", "old_hardware", "new_shield_old_dac_adc"],
+        help="M4 firmware the board runs; lets the serial number be rewritten by touching only its flash sector"
+    )
+    parser.add_argument(
+        "--field",
+        type=field_spec,
+        action="append",
+        default=[],
+        metavar="MARKER:LENGTH=VALUE",
+        help="Also stamp VALUE into the LENGTH-byte field after MARKER (e.g. __CAL_ID__:8=C1234); may be repeated"
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=DUPLICATE_POLICIES,
+        default="refuse",
+        help="What to do if a marker occurs more than once in the firmware: refuse to patch, or patch every copy"
+    )
+    parser.add_argument(
+        "--full-dump",
+        action="store_true",
+        help="Read back the whole M4 flash region instead of just the application image"
+    )
     args = parser.parse_args()
 
     if not re.fullmatch('.{0,3}', args.serial_number):
@@ -203,49 +363,41 @@ def main():
       serial_number = "0" + serial_number
     serial_number = f"DA_2025_{serial_number}"
 
-    port = find_giga_port()
-    if port is None:
-        print("Arduino GIGA not found. Make sure it is connected.")
+    field_offsets = serial_field_offsets(args.target)
+    # Refuse before a DFU cycle is spent on a board whose image cannot be patched
+    if field_offsets and len(field_offsets) > 1 and args.duplicates == "refuse":
+        print(f"Error: The serial number field occurs {len(field_offsets)} times in the M4 firmware. Pass --duplicates all to patch every copy.")
         sys.exit(1)
-    print(f"Found Arduino GIGA on port: {port}")
-    
-    if os.path.exists(TEMP_FIRMWARE):
-      print(f"Temporary firmware file '{TEMP_FIRMWARE}' already exists. Deleting it.")
-      os.remove(TEMP_FIRMWARE)
-
-    trigger_dfu_mode(port)
-
-    try:
-        read_firmware_from_board(TEMP_FIRMWARE)
-    except subprocess.CalledProcessError as e:
-        print(f"Error reading firmware: {e}")
+    # The single-sector rewrite only covers one copy of the field
+    field_offset = field_offsets[0] if field_offsets and len(field_offsets) == 1 else None
+    image_length = None if args.full_dump else m4_image_length(args.target)
+
+    boards = find_giga_ports()
+    if args.port:
+        boards = [board for board in boards if board.device == args.port]
+    if not boards:
+        print("Arduino GIGA not found. Make sure it is connected.")
         sys.exit(1)
-
-    current_serial, _ = read_serial_from_file(TEMP_FIRMWARE)
-    if current_serial:
-        print(f"Firmware currently contains serial number: '{current_serial}'")
-    else:
-        print("No serial number found in firmware; proceeding with update anyway.")
- 
-    if not update_serial_in_file(TEMP_FIRMWARE, serial_number):
-        print("Failed to update the serial number in firmware.")
+    # Picking a board for the user would hand out serial numbers in whatever
+    # order parallel runs happen to start
+    if len(boards) > 1:
+        print(f"Error: {len(boards)} Arduino GIGAs are connected; choose one with --port.")
         sys.exit(1)
+    board = boards[0]
 
+    # Each job locks its board and works in its own scratch directory, so
+    # several boards can be re-serialized from this host at the same time.
     try:
-        flash_firmware_to_board(TEMP_FIRMWARE)
-    except subprocess.CalledProcessError as e:
-        print(f"Error flashing firmware: {e}")
+        with board_lock(board.location or board.device), job_workspace() as workdir:
+            print(f"Found Arduino GIGA on port: {board.device}")
+            ok = reserialize_board(board, serial_number, workdir, field_offset, image_length, args.field, args.duplicates)
+    except TimeoutError as e:
+        print(e)
         sys.exit(1)
 
-    print("Validating...")
-    nop_test(port, serial_number)
-    
-    try:
-        if os.path.exists(TEMP_FIRMWARE):
-            os.remove(TEMP_FIRMWARE)
-    except OSError as e:
-        print(f"Error deleting temporary file {TEMP_FIRMWARE}: {e}")
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
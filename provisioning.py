@@ -0,0 +1,446 @@
+import asyncio
+import os
+import subprocess
+
+from dfu import dfu_util_command, download_async, image_sectors, memory_sectors, run_blocking, run_dfu_util_async, upload_async, wait_for_dfu_device_async
+from dfuse import DfuseElement, DfuseTarget, build_dfuse
+from firmware_image import M4_ADDRESS, M7_ADDRESS, SERIAL_FIELD_LENGTH, SERIAL_MARKER, FieldSpec, PatchedImage, image_sha256, manifest_entry
+from flash_records import changed_runs, forget_record, load_record, make_record, save_record
+from giga import enter_dfu_mode_async, find_port_by_location, nop_test, query_identity, usb_hub, usb_path, wait_for_application_async
+from image_cache import cache_key, cached
+from journal import clear_progress, load_progress, record_stage
+from readback import compare_readback
+from workspace import job_workspace
+
+CORE_ADDRESSES = {"M7": M7_ADDRESS, "M4": M4_ADDRESS}
+
+# The provisioning sequence for each upload mode. 'dfu_enter' and 'boot' only
+# move the board between bootloader and application; the other stages leave a
+# lasting result and are journaled so that a rerun can skip them. With
+# --verify, with_readback() adds a 'readback' stage after the flash stages.
+STAGES = {
+    "separate": ["discover", "dfu_enter", "flash_m7", "boot", "dfu_enter", "flash_m4", "boot", "verify"],
+    "single_session": ["discover", "dfu_enter", "flash_m7", "flash_m4", "boot", "verify"],
+    "bundle": ["discover", "dfu_enter", "flash_bundle", "boot", "verify"],
+}
+FLASH_STAGES = ("flash_m7", "flash_m4", "flash_bundle")
+JOURNALED_STAGES = FLASH_STAGES + ("verify",)
+# Stages that need the board to stay in the bootloader after the one before
+DFU_STAGES = FLASH_STAGES + ("readback",)
+
+
+def with_readback(stages):
+    """Insert a 'readback' stage before every boot that follows a flash."""
+    result = []
+    for stage in stages:
+        if stage == "boot" and result and result[-1] in FLASH_STAGES:
+            result.append("readback")
+        result.append(stage)
+    return result
+
+
+def firmware_file(firmware_name):
+    """Return the path of a file in the firmware directory."""
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(script_dir, "firmware", firmware_name)
+
+
+def bundle_images(target, serial_number, fields=(), duplicates="refuse", deltas=None):
+    """
+    Loads the M7 image and describes the serial-patched M4 image for a board.
+
+    Parameters:
+      target (str): The M4 firmware target.
+      serial_number (str): The full serial number (e.g., 'DA_2025_123').
+      fields (list): Further FieldSpec tuples to stamp into the M4 image.
+      duplicates (str): What to do if a marker occurs more than once in the
+        M4 image: 'refuse' or 'all' (patch every copy).
+      deltas (str): Delta records written by firmware_tool.py generate --deltas
+        to take the serial number overlay from, or None to locate the fields
+        in the M4 image.
+
+    Returns:
+      A tuple (m7_data, m4_image): the M7 image as bytes and the M4 image as a
+      PatchedImage, which is streamed from the base image when it is used.
+
+    Raises:
+      ValueError if a field is missing from the M4 image, occurs more than
+      once under the 'refuse' policy, or a value does not fit, or the delta
+      records do not match the M4 image or serial number.
+    """
+    m4_path = firmware_file(f"firmwareM4_{target}.bin")
+    with open(firmware_file("firmwareM7.bin"), "rb") as f:
+        m7_data = f.read()
+    if deltas:
+        return m7_data, PatchedImage.from_deltas(deltas, serial_number, m4_path)
+    return m7_data, PatchedImage.for_fields(m4_path, [FieldSpec(SERIAL_MARKER, SERIAL_FIELD_LENGTH, serial_number), *fields], duplicates)
+
+
+def build_bundle(target, serial_number, fields=(), duplicates="refuse", deltas=None):
+    """
+    Builds (or reuses) the DfuSe bundle holding both images for one board.
+
+    Bundles are kept in the image cache, keyed by the hashes of both base
+    images, the target, the serial number and any further stamped fields.
+
+    Returns:
+      The path of the bundle.
+    """
+    m7_path = firmware_file("firmwareM7.bin")
+    m4_path = firmware_file(f"firmwareM4_{target}.bin")
+
+    def build():
+        m7_data, m4_image = bundle_images(target, serial_number, fields, duplicates, deltas)
+        data = build_dfuse([DfuseTarget(0, "Internal Flash", [DfuseElement(M7_ADDRESS, m7_data), DfuseElement(M4_ADDRESS, m4_image.read())])])
+        print(f"Built DfuSe bundle for {serial_number}")
+        return data
+
+    stamped = [f"{spec.marker.hex()}:{spec.field_length}={spec.value}" for spec in fields]
+    key = cache_key("dfu", target, serial_number, manifest_entry(m7_path)["sha256"], manifest_entry(m4_path)["sha256"], *stamped)
+    return cached(key, build)
+
+
+async def flash_core(core, data, device, usb_serial=None, leave=True, differential=False):
+    """
+    Writes one core's image and records what was written.
+
+    dfu-util erases every sector of a write before programming it, so the old
+    record is dropped before the first write and the new one saved only once
+    every write went through: an interrupted write leaves no record for
+    --diff to trust.
+
+    Parameters:
+      core (str): 'M7' or 'M4'.
+      data (bytes): The image to write, or a PatchedImage.
+      device (DfuDevice): The board in DFU mode.
+      usb_serial (str): USB serial number of the board, used for the flash record.
+      leave (bool): Whether the board should leave DFU mode after this write.
+      differential (bool): Only write the sectors that differ from the flash record.
+
+    Raises:
+      subprocess.CalledProcessError or subprocess.TimeoutExpired if dfu-util fails.
+    """
+    address = CORE_ADDRESSES[core]
+    # Hashing streams the whole image, so it runs off the event loop
+    record = await run_blocking(make_record, data, address, image_sectors(memory_sectors(device.name), address, len(data)))
+    runs = [(address, len(data))]
+    if differential:
+        changed = changed_runs(record, await run_blocking(load_record, usb_serial, core))
+        if changed is None:
+            print(f"No record of what was last flashed to {core}, writing the whole image.")
+        else:
+            print(f"{sum(length for _, length in changed) // 1024} KiB of {core} flash changed since the last upload.")
+            runs = changed
+            if not runs and leave:
+                # Something has to be written for the board to leave DFU mode
+                runs = [tuple(record["sectors"][0][:2])]
+    await run_blocking(forget_record, usb_serial, core)
+    for i, (start, length) in enumerate(runs):
+        # A PatchedImage is streamed to dfu-util unless only part of it is written
+        chunk = data if (start, length) == (address, len(data)) else data[start - address:start - address + length]
+        # Without ':leave' the board stays in the bootloader for the next write
+        await download_async(chunk, start, device.path, leave and i == len(runs) - 1)
+    await run_blocking(save_record, usb_serial, core, record)
+
+
+def plan_stages(stages, completed):
+    """
+    Drops the stages a rerun does not need to repeat.
+
+    Journaled stages that already completed are skipped, and so are the DFU
+    entries and boot waits that only existed to serve them.
+
+    Parameters:
+      stages (list): The full stage sequence for the upload mode.
+      completed (set): Journaled stages that already completed.
+
+    Returns:
+      The list of stages left to run.
+    """
+    pending = [stage for stage in stages if stage not in completed]
+    plan = []
+    for i, stage in enumerate(pending):
+        if stage == "dfu_enter" and (i + 1 == len(pending) or pending[i + 1] not in FLASH_STAGES):
+            continue
+        if stage == "readback" and (not plan or plan[-1] not in FLASH_STAGES):
+            continue
+        if stage == "boot" and (not plan or plan[-1] not in DFU_STAGES):
+            continue
+        plan.append(stage)
+    return plan
+
+
+class HubScheduler:
+    """
+    Limits how many DFU transfers run at once behind each USB hub.
+
+    Boards on the same USB 2.0 hub share its bandwidth, and too many parallel
+    dfu-util transfers make them all slow down or time out. Only the transfers
+    take a slot, so DFU entry, boot waits and verification on other boards
+    carry on meanwhile.
+    """
+
+    def __init__(self, per_hub):
+        self.per_hub = per_hub
+        self.slots = {}
+
+    def transfer(self, location):
+        """Return the semaphore to hold while transferring to the board at a USB location."""
+        hub = usb_hub(location) or location
+        if hub not in self.slots:
+            self.slots[hub] = asyncio.Semaphore(self.per_hub)
+        return self.slots[hub]
+
+
+class BoardProvisioner:
+    """
+    Drives one board through the provisioning stages.
+
+    Progress is journaled under the board's USB serial number, so if a run
+    fails part way, the next run for the same images resumes at the first
+    incomplete stage instead of starting over.
+
+    Stages are coroutines: dfu-util runs as an asyncio subprocess and serial
+    and file I/O go to the default executor, so one event loop can drive many
+    boards at once. run() is split into prepare(), flash() and settle() so a
+    batch can pipeline them across boards.
+    """
+
+    def __init__(self, board, serial_number, options, scheduler=None):
+        self.board = board
+        self.scheduler = scheduler or HubScheduler(1)
+        self.serial_number = serial_number
+        self.options = options
+        self.usb_serial = board.serial_number
+        self.dfu_path = usb_path(board.location)
+        self.port = board.device
+        self.device = None
+        self.images = {}
+        # Cores written since the board last entered DFU mode
+        self.session = []
+        self.bundle_path = None
+        self.plan = []
+        self.position = 0
+        if options.bundle:
+            self.mode = "bundle"
+        elif options.single_session:
+            self.mode = "single_session"
+        else:
+            self.mode = "separate"
+        self.stages = with_readback(STAGES[self.mode]) if options.verify else STAGES[self.mode]
+
+    def job(self):
+        """Describe what this run writes, so journal entries from other jobs are ignored."""
+        return {
+            "target": self.options.target,
+            "serial_number": self.serial_number,
+            "mode": self.mode,
+            "images": {core: image_sha256(data) for core, data in self.images.items()},
+        }
+
+    def unchanged_cores(self):
+        """Return the cores whose flash record shows they already hold the images."""
+        if self.options.force or not self.usb_serial:
+            return set()
+        # Only trust the records if the board is actually running firmware
+        identity = query_identity(self.port)
+        if identity is None:
+            return set()
+        unchanged = set()
+        for core, data in self.images.items():
+            record = load_record(self.usb_serial, core)
+            if record is not None and record["sha256"] == image_sha256(data):
+                unchanged.add(core)
+        if identity[1] != self.serial_number:
+            unchanged.discard("M4")
+        return unchanged
+
+    async def prepare(self):
+        """
+        Builds the patched images (and the DfuSe bundle, in bundle mode) for this board.
+
+        Touches only files, not the board, so it can run well ahead of the
+        board's turn to be flashed.
+
+        Returns:
+          True if the images are ready, False otherwise.
+        """
+        try:
+            self.images = dict(zip(("M7", "M4"), await run_blocking(bundle_images, self.options.target, self.serial_number, self.options.field, self.options.duplicates, self.options.deltas)))
+            if self.mode == "bundle":
+                self.bundle_path = await run_blocking(build_bundle, self.options.target, self.serial_number, self.options.field, self.options.duplicates, self.options.deltas)
+        except ValueError as e:
+            print(f"Error preparing firmware for {self.serial_number}: {e}")
+            return False
+        return True
+
+    async def flash(self):
+        """
+        Runs the pending stages up to and including the last transfer to the board.
+
+        Returns:
+          True if every write went through, False otherwise.
+        """
+        print()
+        print(f"Found Arduino GIGA on {self.port}")
+        # Discovery always runs first, since checking for unchanged cores needs the port
+        if not await self.stage_discover(None):
+            return False
+        completed = await run_blocking(load_progress, self.usb_serial, await run_blocking(self.job))
+        if completed:
+            print(f"Resuming after {', '.join(stage for stage in self.stages if stage in completed)}.")
+        completed.add("discover")
+        skip = await run_blocking(self.unchanged_cores) if self.port is not None else set()
+        if skip:
+            print(f"{' and '.join(sorted(skip))} firmware is already up to date, skipping it.")
+            completed |= {f"flash_{core.lower()}" for core in skip}
+            if skip == {"M7", "M4"}:
+                completed.add("flash_bundle")
+
+        self.plan = plan_stages(self.stages, completed)
+        flashes = [i for i, stage in enumerate(self.plan) if stage in FLASH_STAGES]
+        return await self.run_stages(flashes[-1] + 1 if flashes else 0)
+
+    async def settle(self):
+        """
+        Runs the stages left after flash(): waiting for the firmware to boot and verifying it.
+
+        Returns:
+          True if the board ended up verified, False otherwise.
+        """
+        if not await self.run_stages(len(self.plan)):
+            return False
+        await run_blocking(clear_progress, self.usb_serial)
+        return True
+
+    async def run(self):
+        """
+        Runs every stage that is still pending for this board.
+
+        Returns:
+          True if the board ended up verified, False otherwise.
+        """
+        return await self.prepare() and await self.flash() and await self.settle()
+
+    async def run_stages(self, end):
+        """Run the planned stages up to (not including) index end."""
+        job = await run_blocking(self.job)
+        while self.position < end:
+            stage = self.plan[self.position]
+            next_stage = self.plan[self.position + 1] if self.position + 1 < len(self.plan) else None
+            if not await getattr(self, f"stage_{stage}")(next_stage):
+                print(f"Provisioning stopped at stage '{stage}'.")
+                return False
+            if stage in JOURNALED_STAGES:
+                await run_blocking(record_stage, self.usb_serial, job, stage)
+            self.position += 1
+        return True
+
+    async def stage_discover(self, next_stage):
+        port = await run_blocking(find_port_by_location, self.board.location) if self.board.location else self.board.device
+        if port is not None:
+            self.port = port
+            return True
+        # A previous run may have left the board waiting in the bootloader
+        self.device = await wait_for_dfu_device_async(self.dfu_path, timeout=0)
+        if self.device is None:
+            print("Error: Board is no longer connected.")
+            return False
+        self.port = None
+        return True
+
+    async def stage_dfu_enter(self, next_stage):
+        if self.port is None and self.device is not None:
+            return True
+        self.device = await enter_dfu_mode_async(self.port, self.dfu_path)
+        self.port = None
+        self.session = []
+        return self.device is not None
+
+    async def flash_image(self, core, leave):
+        try:
+            async with self.scheduler.transfer(self.board.location):
+                await flash_core(core, self.images[core], self.device, self.usb_serial, leave, self.options.diff)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            print(f"Error uploading firmware: {e}")
+            return False
+        self.session.append(core)
+        print(f"{core} firmware uploaded successfully!")
+        return True
+
+    async def stage_flash_m7(self, next_stage):
+        print("Uploading M7 firmware...")
+        return await self.flash_image("M7", next_stage not in DFU_STAGES)
+
+    async def stage_flash_m4(self, next_stage):
+        print("Uploading M4 firmware...")
+        return await self.flash_image("M4", next_stage not in DFU_STAGES)
+
+    async def stage_flash_bundle(self, next_stage):
+        print("Uploading M7 and M4 firmware from DfuSe bundle...")
+        # As in flash_core, a failed write must not leave the old records behind
+        for core in self.images:
+            await run_blocking(forget_record, self.usb_serial, core)
+        try:
+            # Addresses come from the DfuSe file itself
+            async with self.scheduler.transfer(self.board.location):
+                await run_dfu_util_async(dfu_util_command(
+                    *(("-s", ":leave") if next_stage not in DFU_STAGES else ()),
+                    "-D", self.bundle_path,
+                    dfu_path=self.device.path
+                ))
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            print(f"Error uploading firmware: {e}")
+            return False
+        self.session = ["M7", "M4"]
+        print("M7 and M4 firmware uploaded successfully!")
+        sectors = memory_sectors(self.device.name)
+        for core, data in self.images.items():
+            address = CORE_ADDRESSES[core]
+            record = await run_blocking(make_record, data, address, image_sectors(sectors, address, len(data)))
+            await run_blocking(save_record, self.usb_serial, core, record)
+        return True
+
+    async def stage_readback(self, next_stage):
+        sectors = memory_sectors(self.device.name)
+        with job_workspace() as workdir:
+            for i, core in enumerate(self.session):
+                data = self.images[core]
+                address = CORE_ADDRESSES[core]
+                path = os.path.join(workdir, f"{core}.bin")
+                print(f"Reading back {core} flash...")
+                try:
+                    async with self.scheduler.transfer(self.board.location):
+                        await upload_async(path, address, len(data), self.device.path, i == len(self.session) - 1)
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                    print(f"Error reading back firmware: {e}")
+                    return False
+                mismatch = await run_blocking(compare_readback, data, path, address, image_sectors(sectors, address, len(data)))
+                if mismatch is not None:
+                    sector, addresses = mismatch
+                    print(f"Error: {core} flash does not match the image, first in the sector at 0x{sector:08x}.")
+                    if addresses:
+                        print(f"Differing bytes at {', '.join(f'0x{a:08x}' for a in addresses)}")
+                    # Neither the journal nor the flash record may claim this core is written
+                    await run_blocking(forget_record, self.usb_serial, core)
+                    await run_blocking(clear_progress, self.usb_serial)
+                    return False
+                print(f"{core} flash matches the image.")
+        self.session = []
+        return True
+
+    async def stage_boot(self, next_stage):
+        print()
+        print("Waiting for firmware to boot...")
+        self.device = None
+        self.port = await wait_for_application_async(self.board.location)
+        if self.port is None:
+            print("Error: Firmware did not come up.")
+            return False
+        return True
+
+    async def stage_verify(self, next_stage):
+        if self.port is None:
+            print("Error: Board is not running its firmware.")
+            return False
+        return await run_blocking(nop_test, self.port, self.serial_number)
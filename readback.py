@@ -0,0 +1,70 @@
+import hashlib
+
+from firmware_image import image_sha256
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_REPORTED_MISMATCHES = 16
+
+
+def mismatch_offsets(expected, actual, limit=MAX_REPORTED_MISMATCHES):
+    """
+    Lists where two equally long chunks differ.
+
+    Uses NumPy to compare the chunks as byte arrays when it is installed, and a
+    plain byte-by-byte loop otherwise.
+
+    Returns:
+      The offsets (relative to the chunk) of up to limit differing bytes.
+    """
+    if numpy is not None:
+        differing = numpy.flatnonzero(numpy.frombuffer(expected, numpy.uint8) != numpy.frombuffer(actual, numpy.uint8))
+        return [int(offset) for offset in differing[:limit]]
+    offsets = []
+    for offset, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            offsets.append(offset)
+            if len(offsets) == limit:
+                break
+    return offsets
+
+
+def compare_readback(image, readback_path, address, sectors):
+    """
+    Compares flash read back from a board with the image that was written to it.
+
+    The readback is streamed sector by sector and hashed along the way;
+    identical sectors are compared with a single memcmp, and only the first
+    mismatching sector is examined byte by byte.
+
+    Parameters:
+      image (bytes): The image that was written, or a firmware_image.PatchedImage.
+      readback_path (str): File written by dfu-util -U for the same region.
+      address (int): Flash address of the image.
+      sectors (list): (address, size) tuples covering the image, from dfu.image_sectors.
+
+    Returns:
+      None if the flash holds the image, otherwise a tuple (sector, addresses)
+      of the first sector that differs and the flash addresses of up to
+      MAX_REPORTED_MISMATCHES differing bytes in it.
+    """
+    digest = hashlib.sha256()
+    with open(readback_path, "rb") as f:
+        for start, size in sectors:
+            begin = max(start, address) - address
+            expected = image[begin:start + size - address]
+            actual = f.read(len(expected))
+            digest.update(actual)
+            if actual == expected:
+                continue
+            offsets = mismatch_offsets(expected[:len(actual)], actual)
+            if len(actual) < len(expected):
+                offsets.append(len(actual))
+            return start, [address + begin + offset for offset in offsets[:MAX_REPORTED_MISMATCHES]]
+    if digest.hexdigest() != image_sha256(image):
+        # Only possible if the sectors do not cover the whole image
+        return address, []
+    return None
@@ -0,0 +1,53 @@
+import struct
+
+import pytest
+
+from dfuse import SUFFIX_SIZE, DfuseElement, DfuseTarget, build_dfuse, dfu_crc, parse_dfuse, validate_dfuse
+
+TARGETS = [
+    DfuseTarget(0, "Internal Flash", [
+        DfuseElement(0x08040000, bytes(range(256)) * 3),
+        DfuseElement(0x08100000, b"__SERIAL_NUMBER__DA_2025_001\x00"),
+    ]),
+    DfuseTarget(1, "", [DfuseElement(0x90000000, b"\xff" * 17)]),
+]
+
+
+def test_dfu_crc_known_answer():
+    # CRC-32 of the standard check string is 0xCBF43926; DFU omits the final inversion
+    assert dfu_crc(b"123456789") == 0x340BC6D9
+
+
+def test_round_trip():
+    data = build_dfuse(TARGETS, vid=0x1234, pid=0x5678, bcd_device=0x0200)
+    parsed = parse_dfuse(data)
+    assert (parsed.vid, parsed.pid, parsed.bcd_device) == (0x1234, 0x5678, 0x0200)
+    assert parsed.targets == TARGETS
+    assert build_dfuse(parsed.targets, parsed.vid, parsed.pid, parsed.bcd_device) == data
+
+
+def test_suffix_carries_crc_of_everything_before_it():
+    data = build_dfuse(TARGETS)
+    assert struct.unpack("<I", data[-4:])[0] == dfu_crc(data[:-4])
+
+
+@pytest.mark.parametrize("offset", [0, 11, 300, -SUFFIX_SIZE, -1])
+def test_corruption_is_detected(offset):
+    data = bytearray(build_dfuse(TARGETS))
+    data[offset] ^= 0x01
+    with pytest.raises(ValueError):
+        parse_dfuse(bytes(data))
+    assert not validate_dfuse(bytes(data))
+
+
+def test_truncated_file_is_rejected():
+    data = build_dfuse(TARGETS)
+    with pytest.raises(ValueError):
+        parse_dfuse(data[:-5])
+
+
+def test_validate_checks_expected_elements():
+    data = build_dfuse(TARGETS)
+    elements = [element for target in TARGETS for element in target.elements]
+    assert validate_dfuse(data, elements)
+    assert not validate_dfuse(data, elements[:1])
@@ -0,0 +1,88 @@
+import pytest
+
+from firmware_image import SERIAL_MARKER, FieldMatch, FieldSpec, field_overlays, find_fields, scan_fields
+
+CAL_MARKER = b"__CAL_ID__"
+
+# Fields at the very start, back to back, and cut off by the end of the file
+DUMP = (
+    SERIAL_MARKER + b"DA_2025_001\x00"
+    + b"\xff" * 7
+    + CAL_MARKER + b"C1234\x00\x00\x00"
+    + SERIAL_MARKER + b"DA_2025_002\x00"
+    + b"\x00" * 23
+    + SERIAL_MARKER + b"DA_2"
+)
+FIELDS = [(SERIAL_MARKER, 12), (CAL_MARKER, 8)]
+
+
+def expected_matches(data):
+    lengths = dict(FIELDS)
+    matches = []
+    for marker, offsets in find_fields(data, list(lengths)).items():
+        for offset in offsets:
+            value = data[offset:offset + lengths[marker]].rstrip(b"\x00").decode("ascii")
+            matches.append(FieldMatch(marker, offset, value))
+    return sorted(matches, key=lambda match: match.offset)
+
+
+@pytest.fixture
+def dump(tmp_path):
+    path = tmp_path / "dump.bin"
+    path.write_bytes(DUMP)
+    return str(path)
+
+
+def test_scan_reports_every_field_in_file_order(dump):
+    matches = list(scan_fields(dump, FIELDS))
+    assert [(match.marker, match.value) for match in matches] == [
+        (SERIAL_MARKER, "DA_2025_001"),
+        (CAL_MARKER, "C1234"),
+        (SERIAL_MARKER, "DA_2025_002"),
+        (SERIAL_MARKER, "DA_2"),
+    ]
+    assert matches == expected_matches(DUMP)
+
+
+@pytest.mark.parametrize("chunk_size", range(1, len(DUMP) + 2))
+def test_scan_is_independent_of_chunk_boundaries(dump, chunk_size):
+    # Every chunk size puts the boundary inside a marker or a value somewhere
+    assert list(scan_fields(dump, FIELDS, chunk_size)) == expected_matches(DUMP)
+
+
+def test_scan_empty_file(tmp_path):
+    path = tmp_path / "empty.bin"
+    path.write_bytes(b"")
+    assert list(scan_fields(str(path), FIELDS)) == []
+
+
+def test_overlays_refuse_duplicates():
+    with pytest.raises(ValueError, match="occurs 3 times"):
+        field_overlays(DUMP, [FieldSpec(SERIAL_MARKER, 12, "DA_2025_003")])
+
+
+def test_overlays_patch_every_copy():
+    data = DUMP[:-len(SERIAL_MARKER) - 4]
+    overlays, old_values = field_overlays(data, [FieldSpec(SERIAL_MARKER, 12, "DA_2025_003")], duplicates="all")
+    assert [offset for offset, _ in overlays] == find_fields(data, [SERIAL_MARKER])[SERIAL_MARKER]
+    assert old_values[SERIAL_MARKER] == (len(SERIAL_MARKER), "DA_2025_001")
+
+
+def test_overlays_trust_matching_hints():
+    data = DUMP[:-len(SERIAL_MARKER) - 4]
+    first = len(SERIAL_MARKER)
+    overlays, _ = field_overlays(data, [FieldSpec(SERIAL_MARKER, 12, "DA_2025_003")], offsets={SERIAL_MARKER: [first]})
+    assert [offset for offset, _ in overlays] == [first]
+
+
+def test_overlays_scan_when_hints_are_stale():
+    data = DUMP[:-len(SERIAL_MARKER) - 4]
+    with pytest.raises(ValueError, match="occurs 2 times"):
+        field_overlays(data, [FieldSpec(SERIAL_MARKER, 12, "DA_2025_003")], offsets={SERIAL_MARKER: [3]})
+
+
+def test_overlays_missing_marker():
+    spec = FieldSpec(b"__HW_REV__", 4, "C")
+    with pytest.raises(ValueError, match="No __HW_REV__ field"):
+        field_overlays(DUMP, [spec])
+    assert field_overlays(DUMP, [spec], required=False) == ([], {})
@@ -0,0 +1,93 @@
+import itertools
+import os
+
+import pytest
+
+import image_cache
+from workspace import read_state
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache")
+    monkeypatch.setattr(image_cache, "CACHE_DIR", path)
+    monkeypatch.setattr(image_cache, "INDEX_PATH", os.path.join(path, "index.json"))
+    # Distinct, increasing last_used stamps however fast the test runs
+    clock = itertools.count(1000)
+    monkeypatch.setattr(image_cache.time, "time", lambda: next(clock))
+    return path
+
+
+def test_hit_returns_stored_file():
+    path = image_cache.store("a.bin", b"A" * 10)
+    assert image_cache.lookup("a.bin") == path
+    with open(path, "rb") as f:
+        assert f.read() == b"A" * 10
+
+
+def test_miss_returns_none():
+    assert image_cache.lookup("missing.bin") is None
+
+
+def test_evicts_least_recently_used(cache_dir):
+    image_cache.store("a.bin", b"A" * 10, limit=25)
+    image_cache.store("b.bin", b"B" * 10, limit=25)
+    # Using a makes b the least recently used entry
+    assert image_cache.lookup("a.bin") is not None
+    image_cache.store("c.bin", b"C" * 10, limit=25)
+
+    assert set(read_state(image_cache.INDEX_PATH)) == {"a.bin", "c.bin"}
+    assert not os.path.exists(os.path.join(cache_dir, "b.bin"))
+    assert image_cache.lookup("b.bin") is None
+    assert image_cache.lookup("a.bin") is not None
+
+
+def test_evicts_until_under_limit():
+    for key in ("a.bin", "b.bin", "c.bin"):
+        image_cache.store(key, b"x" * 10, limit=100)
+    image_cache.store("big.bin", b"y" * 81, limit=100)
+    assert set(read_state(image_cache.INDEX_PATH)) == {"c.bin", "big.bin"}
+
+
+def test_never_evicts_the_new_entry():
+    image_cache.store("a.bin", b"A" * 10, limit=5)
+    path = image_cache.store("b.bin", b"B" * 10, limit=5)
+    assert set(read_state(image_cache.INDEX_PATH)) == {"b.bin"}
+    assert image_cache.lookup("b.bin") == path
+
+
+@pytest.mark.parametrize("damage", ["modify", "truncate", "delete"])
+def test_corrupt_hit_is_discarded(damage, capsys):
+    path = image_cache.store("a.bin", b"A" * 10)
+    if damage == "delete":
+        os.remove(path)
+    else:
+        with open(path, "r+b") as f:
+            if damage == "modify":
+                f.write(b"B")
+            else:
+                f.truncate(5)
+
+    assert image_cache.lookup("a.bin") is None
+    assert "Discarding corrupt cache entry a.bin" in capsys.readouterr().out
+    assert "a.bin" not in read_state(image_cache.INDEX_PATH)
+    assert not os.path.exists(path)
+
+
+def test_cached_rebuilds_corrupt_entry():
+    builds = []
+
+    def build():
+        builds.append(1)
+        return b"A" * 10
+
+    path = image_cache.cached("a.bin", build)
+    assert image_cache.cached("a.bin", build) == path
+    assert len(builds) == 1
+
+    with open(path, "r+b") as f:
+        f.write(b"B")
+    assert image_cache.cached("a.bin", build) == path
+    assert len(builds) == 2
+    with open(path, "rb") as f:
+        assert f.read() == b"A" * 10
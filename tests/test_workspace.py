@@ -0,0 +1,137 @@
+import json
+import multiprocessing
+import os
+import time
+import uuid
+
+import pytest
+
+from workspace import SCRATCH_DIR, host_lock, job_workspace, update_state
+
+JOBS = 8
+WRITES_PER_JOB = 25
+
+# fork keeps the test module importable in the workers without re-running pytest's setup
+context = multiprocessing.get_context("fork")
+
+
+def _scratch_job(results):
+    with job_workspace() as path:
+        with open(os.path.join(path, "owner"), "w") as f:
+            f.write(str(os.getpid()))
+        time.sleep(0.05)
+        with open(os.path.join(path, "owner")) as f:
+            results.put((path, f.read() == str(os.getpid())))
+
+
+def _locked_job(key, inside, errors):
+    with host_lock(key, timeout=30):
+        try:
+            # Fails if another job is inside the lock at the same time
+            fd = os.open(inside, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            errors.put("two holders")
+            return
+        time.sleep(0.01)
+        os.close(fd)
+        os.remove(inside)
+
+
+def _state_writer(path, job):
+    def append(state):
+        state.setdefault("writes", []).append(job)
+        state["count"] = state.get("count", 0) + 1
+
+    for _ in range(WRITES_PER_JOB):
+        update_state(path, append)
+
+
+def _state_reader(path, stop, errors):
+    while not stop.is_set():
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            errors.put(f"torn read: {e}")
+            return
+        if state["count"] != len(state["writes"]):
+            errors.put("inconsistent state")
+            return
+
+
+def _run(processes):
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+
+def test_scratch_directories_are_disjoint():
+    results = context.Queue()
+    _run([context.Process(target=_scratch_job, args=(results,)) for _ in range(JOBS)])
+    outcomes = [results.get(timeout=5) for _ in range(JOBS)]
+    paths = [path for path, _ in outcomes]
+    assert len(set(paths)) == JOBS
+    assert all(untouched for _, untouched in outcomes)
+    if SCRATCH_DIR is not None:
+        assert all(os.path.dirname(path) == SCRATCH_DIR for path in paths)
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_held_lock_refuses_second_holder():
+    key = f"test_{uuid.uuid4().hex}"
+    refused = context.Queue()
+
+    def try_lock():
+        try:
+            with host_lock(key, timeout=0.2):
+                refused.put(False)
+        except TimeoutError:
+            refused.put(True)
+
+    with host_lock(key):
+        _run([context.Process(target=try_lock)])
+        assert refused.get(timeout=5)
+    # Released again once the holder is done
+    with host_lock(key, timeout=0):
+        pass
+
+
+def test_lock_is_exclusive_across_jobs(tmp_path):
+    key = f"test_{uuid.uuid4().hex}"
+    errors = context.Queue()
+    inside = str(tmp_path / "inside")
+    _run([context.Process(target=_locked_job, args=(key, inside, errors)) for _ in range(JOBS)])
+    assert errors.empty()
+
+
+def test_state_is_never_torn(tmp_path):
+    path = str(tmp_path / "state" / "stress.json")
+    stop = context.Event()
+    errors = context.Queue()
+    reader = context.Process(target=_state_reader, args=(path, stop, errors))
+    reader.start()
+    try:
+        _run([context.Process(target=_state_writer, args=(path, job)) for job in range(JOBS)])
+    finally:
+        stop.set()
+        reader.join(10)
+    assert errors.empty()
+    with open(path) as f:
+        state = json.load(f)
+    assert state["count"] == JOBS * WRITES_PER_JOB
+    assert sorted(state["writes"]) == sorted(job for job in range(JOBS) for _ in range(WRITES_PER_JOB))
+
+
+@pytest.mark.parametrize("timeout", [0, 0.1])
+def test_lock_timeout_raises(timeout):
+    key = f"test_{uuid.uuid4().hex}"
+    with host_lock(key):
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            with host_lock(key, timeout=timeout):
+                pass
+        assert time.monotonic() - start < timeout + 1
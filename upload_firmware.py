@@ -1,151 +1,137 @@
 import re
-import serial
-import time
 import os
-import subprocess
-import serial.tools.list_ports
 import argparse
+import asyncio
+from contextlib import ExitStack
 
-def read_serial(bin_path, marker=b'__SERIAL_NUMBER__'):
-    with open(bin_path, 'rb') as f:
-        data = f.read()
+from firmware_image import DUPLICATE_POLICIES, field_spec, positive_int, validate_image
+from giga import find_giga_ports, natural_key, usb_hub
+from provisioning import BoardProvisioner, HubScheduler
+from workspace import board_lock
 
-    index = data.find(marker)
-    if index == -1:
-        print("Serial number not found.")
+async def provision_board(board, serial_number, options, scheduler=None):
+    # Keeps patch_serial_number.py and other uploads off this board meanwhile
+    try:
+        with board_lock(board.location or board.device):
+            return await BoardProvisioner(board, serial_number, options, scheduler).run()
+    except TimeoutError as e:
+        print(e)
+        return False
+
+def assign_serial_numbers(serial_numbers, count):
+    if len(serial_numbers) == count:
+        return serial_numbers
+    if len(serial_numbers) != 1:
+        print(f"Error: {count} boards found, but {len(serial_numbers)} serial numbers given.")
         return None
+    first = serial_numbers[0]
+    if not first.isdigit() or int(first) + count - 1 > 999:
+        print("Error: A single starting serial number must be numeric and leave room for every board.")
+        return None
+    return [f"{int(first) + i:03d}" for i in range(count)]
 
-    serial_bytes = data[index + 17:index + 29]
-
-    serial = serial_bytes.rstrip(b'\x00').decode('ascii')
-
-    return serial
-
-
-def patch_serial(bin_path, new_serial, output_path):
-    with open(bin_path, 'rb') as f:
-        data = f.read()
+async def provision_all(boards, serial_numbers, options):
+    scheduler = HubScheduler(options.per_hub)
     
-    new_serial = "__SERIAL_NUMBER__" + new_serial
+    hubs = {}
+    for board in boards:
+        hubs.setdefault(usb_hub(board.location), []).append(board.device)
+    for hub, ports in sorted(hubs.items(), key=lambda item: natural_key(item[0])):
+        print(f"USB hub {hub}: {', '.join(ports)}")
     
-    old_serial = read_serial(bin_path)
+    # Three stages connected by a queue: images are prepared ahead, flash
+    # workers pull ready boards and hand them off to verification as soon as
+    # the last transfer is done, so the USB transfer is all a worker waits on.
+    provisioners = [BoardProvisioner(board, f"DA_2025_{serial_number}", options, scheduler) for board, serial_number in zip(boards, serial_numbers)]
+    prepared = asyncio.Queue(maxsize=options.workers)
+    results = {}
+    settling = []
     
-    print(f"Found old serial number: {old_serial}")
-
-    old_serial = ("__SERIAL_NUMBER__" + old_serial).encode('ascii')
-    
-    if old_serial is None:
-        print("No serial number found to patch.")
-        return
+    def failed(provisioner, e):
+        # One board going wrong must not take the rest of the batch with it
+        print(f"Error provisioning {provisioner.serial_number} on {provisioner.board.device}: {e!r}")
+        results[provisioner] = False
     
-    new_serial_bytes = new_serial.encode('ascii')
-    new_serial_bytes = new_serial_bytes.ljust(len(old_serial), b'\x00')
-
-    if old_serial not in data:
-        print("Placeholder not found.")
-        return
-
-    data = data.replace(old_serial, new_serial_bytes, 1)
-
-    with open(output_path, 'wb') as f:
-        f.write(data)
-
-    print(f"Patched and saved to {output_path}")
-
-def find_giga_port():
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        if port.description is not None and port.manufacturer is not None and "Giga" in port.description and "Arduino" in port.manufacturer:
-            return port.device
-    return None
-
-def trigger_dfu_mode(port):
-    try:
-        with serial.Serial(port, 1200, timeout=1) as ser:
-            ser.close()
-            print(f"Triggered DFU mode on {port}.")
-        time.sleep(2)
-    except Exception as e:
-        print(f"Error triggering DFU mode: {e}")
-
-def upload_firmwareM4(firmware_name, serial_number):
-    try:
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        firmware_path = os.path.join(script_dir, 'firmware', firmware_name)
-        
-        if serial_number is None:
-            print("No serial number provided!")
-            return
-        if not re.fullmatch('DA_2025_.{3}', serial_number):
-            print("Invalid serial number format!")
-            print("Expected format: DA_2025_XXX")
-            return
-        
-        patch_serial(firmware_path, serial_number, firmware_path)
-        
-        subprocess.run([
-            "dfu-util",
-            "-a", "0",
-            "-s", "0x08100000:leave",
-            "-D", firmware_path
-        ], check=True)
-        print(f"M{firmware_name[9]} firmware uploaded successfully!")
-    except subprocess.CalledProcessError as e:
-        print(f"Error uploading firmware: {e}")
-
-def upload_firmwareM7(firmware_name):
-    try:
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        firmware_path = os.path.join(script_dir, 'firmware', firmware_name)
-        subprocess.run([
-            "dfu-util",
-            "-a", "0",
-            "-s", "0x08040000:leave",
-            "-D", firmware_path
-        ], check=True)
-        print(f"M{firmware_name[9]} firmware uploaded successfully!")
-    except subprocess.CalledProcessError as e:
-        print(f"Error uploading firmware: {e}")
-
-def nop_test(expected_serial_number):
-    try:
-        with serial.Serial(port, 115200, timeout=2) as ser:
-            print()
-            print(f"Testing NOP on {ser.port}...")
-            
-            ser.write("NOP\r\n".encode())
-            
-            response = ser.readline().decode().strip()
-            
-            if response == "NOP":
-                print("NOP test passed: Correct response received.")
+    async def prepare():
+        for provisioner in provisioners:
+            try:
+                ready = await provisioner.prepare()
+            except Exception as e:
+                failed(provisioner, e)
+                continue
+            if ready:
+                await prepared.put(provisioner)
             else:
-                print(f"NOP test failed: Expected 'nop', but received '{response}'")
-                return
-            
-            
-            ser.write("*IDN?\r\n".encode())
-            id = ser.readline().decode().strip()
-            
-            ser.write("SERIAL_NUMBER\r\n".encode())
-            serial_number = ser.readline().decode().strip()
-            
-            print()
-            print(f"ID: {id}, Serial Number: {serial_number}")
-            if serial_number != expected_serial_number:
-                print(f"Serial number mismatch: Expected {expected_serial_number}, but got {serial_number}")
-                return
-            print(f"Firmware successfully uploaded.")
-            
-    except Exception as e:
-        print(f"Error during NOP test: {e}")
+                results[provisioner] = False
+        for _ in range(options.workers):
+            await prepared.put(None)
+    
+    async def settle(provisioner, lock):
+        with lock:
+            try:
+                results[provisioner] = await provisioner.settle()
+            except Exception as e:
+                failed(provisioner, e)
+    
+    async def flash_worker():
+        while (provisioner := await prepared.get()) is not None:
+            lock = ExitStack()
+            try:
+                # Held until verification is done, see provision_board()
+                lock.enter_context(board_lock(provisioner.board.location or provisioner.board.device))
+            except TimeoutError as e:
+                print(e)
+                results[provisioner] = False
+                continue
+            with lock:
+                try:
+                    flashed = await provisioner.flash()
+                except Exception as e:
+                    failed(provisioner, e)
+                    continue
+                if not flashed:
+                    results[provisioner] = False
+                    continue
+                settling.append(asyncio.create_task(settle(provisioner, lock.pop_all())))
+    
+    await asyncio.gather(prepare(), *(flash_worker() for _ in range(options.workers)))
+    await asyncio.gather(*settling)
+    
+    print()
+    print("Batch results:")
+    for provisioner in provisioners:
+        board = provisioner.board
+        print(f"  {board.device} ({board.location}): {provisioner.serial_number} {'OK' if results.get(provisioner) else 'FAILED'}")
+    return all(results.get(provisioner) for provisioner in provisioners)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Upload firmware to Arduino GIGA.')
     
     parser.add_argument('target', type=str, help='The target firmware to upload.', choices=['new_hardware', 'old_hardware', 'new_shield_old_dac_adc'], default='new_hardware')
     
-    parser.add_argument('serial_number', type=str, help='Serial number to patch in the firmware.', default=None)
+    parser.add_argument('serial_number', type=str, nargs='+', help='Serial number to patch in the firmware. With --all, either one per board or a numeric starting serial number.')
+    
+    parser.add_argument('--all', action='store_true', help='Flash every connected Arduino GIGA in parallel.')
+    
+    parser.add_argument('--workers', type=positive_int, default=8, help='Maximum number of boards flashed at once with --all; images for as many more are prepared ahead.')
+    
+    parser.add_argument('--per-hub', type=positive_int, default=2, help='Maximum number of DFU transfers at once on boards behind the same USB hub with --all.')
+    
+    parser.add_argument('--single-session', action='store_true', help='Write M7 and M4 in one DFU session instead of resetting the board between them.')
+    
+    parser.add_argument('--bundle', action='store_true', help='Flash both cores from a cached DfuSe bundle in a single dfu-util run.')
+    
+    parser.add_argument('--diff', action='store_true', help='Only rewrite flash sectors that changed since the last upload to the same board.')
+    
+    parser.add_argument('--field', type=field_spec, action='append', default=[], metavar='MARKER:LENGTH=VALUE', help='Also stamp VALUE into the LENGTH-byte field after MARKER in the M4 image (e.g. __HW_REV__:4=C); may be repeated.')
+    
+    parser.add_argument('--duplicates', choices=DUPLICATE_POLICIES, default='refuse', help='What to do if the serial number (or another stamped) marker occurs more than once in the M4 image: refuse to upload, or patch every copy.')
+    
+    parser.add_argument('--deltas', type=str, help='Take the serial number overlay of each M4 image from delta records written by firmware_tool.py generate --deltas instead of searching the image for it.')
+    
+    parser.add_argument('--verify', action='store_true', help='Read the flash back after writing it and compare it with the images before booting the board.')
+    
+    parser.add_argument('--force', action='store_true', help='Flash every core even if the board already runs the same firmware.')
     
     args = parser.parse_args()
     
@@ -158,34 +144,41 @@ if __name__ == "__main__":
     if not os.path.exists(firmware_path_m7):
         print(f"Error: Firmware file '{firmware_path_m7}' not found.")
         exit(1)
-    if args.serial_number is None:
-        print("Error: Serial number is required.")
+    # Catch truncated or mixed-up images before any board is reset into DFU mode
+    if not validate_image(firmware_path_m7) or not validate_image(firmware_path_m4):
+        exit(1)
+    # A bundle is written whole in one dfu-util run
+    if args.bundle and args.diff:
+        print("Error: --diff cannot be combined with --bundle, which always rewrites both images.")
+        exit(1)
+    if args.bundle and args.single_session:
+        print("Error: --single-session cannot be combined with --bundle, which already writes both cores in one DFU session.")
         exit(1)
-    if not re.fullmatch('.{3}', args.serial_number):
-        print("Error: Invalid serial number format.")
-        print("Expected format is 3 characters!")
+    if args.deltas and args.field:
+        print("Error: --deltas only holds serial numbers and cannot be combined with --field.")
         exit(1)
+    if args.deltas and not os.path.exists(args.deltas):
+        print(f"Error: Delta records '{args.deltas}' not found.")
+        exit(1)
+    if not args.all and len(args.serial_number) != 1:
+        print("Error: Exactly one serial number is required.")
+        exit(1)
+    for serial_number in args.serial_number:
+        if not re.fullmatch('.{3}', serial_number):
+            print("Error: Invalid serial number format.")
+            print("Expected format is 3 characters!")
+            exit(1)
     
-    port = find_giga_port()
-    if port:
-        print()
-        print(f"Found Arduino GIGA on {port}")
-        print("Uploading M7 firmware...")
-        trigger_dfu_mode(port)
-        time.sleep(0.5)
-        upload_firmwareM7('firmwareM7.bin')
-        
-        print()
-        print("Waiting for M7 firmware to boot...")
-        time.sleep(2)
-        print("Uploading M4 firmware...")
-        trigger_dfu_mode(port)
-        time.sleep(0.5)
-        upload_firmwareM4(f'firmwareM4_{args.target}.bin', f"DA_2025_{args.serial_number}")
-        print()
-        print("Waiting for M4 firmware to boot...")
-        time.sleep(2)
-        
-        nop_test(f"DA_2025_{args.serial_number}")
-    else:
+    boards = find_giga_ports()
+    if not boards:
         print("Arduino GIGA not found. Make sure it is connected.")
+        exit(1)
+    
+    if args.all:
+        serial_numbers = assign_serial_numbers(args.serial_number, len(boards))
+        if serial_numbers is None:
+            exit(1)
+        if not asyncio.run(provision_all(boards, serial_numbers, args)):
+            exit(1)
+    elif not asyncio.run(provision_board(boards[0], f"DA_2025_{args.serial_number[0]}", args)):
+        exit(1)
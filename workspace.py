@@ -0,0 +1,133 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+LOCK_DIR = os.path.join(tempfile.gettempdir(), "giga_firmware_locks")
+# Readbacks and patched images are scratch data, so they are kept in RAM where
+# a tmpfs is available, like the images dfu.image_handoff passes to dfu-util
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+LOCK_POLL_INTERVAL = 0.1
+STATE_LOCK_TIMEOUT = 10
+
+
+@contextmanager
+def job_workspace():
+    """
+    Creates a private scratch directory for one job and removes it afterwards.
+
+    The directory is created in SCRATCH_DIR (/dev/shm) if there is one, and in
+    the system temp directory otherwise.
+
+    Yields:
+      The path of the directory.
+    """
+    path = tempfile.mkdtemp(prefix="giga_job_", dir=SCRATCH_DIR)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _try_lock(fd):
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def host_lock(key, timeout=0):
+    """
+    Holds an advisory lock shared by every process on this host.
+
+    The OS drops the lock if the process dies, so a crashed job never leaves a
+    stale lock behind.
+
+    Parameters:
+      key (str): Name of the locked resource.
+      timeout (float): Seconds to wait for another job to release it.
+
+    Raises:
+      TimeoutError if the resource is still locked after the timeout.
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    lock_path = os.path.join(LOCK_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".lock")
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        deadline = time.monotonic() + timeout
+        while not _try_lock(fd):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"{key} is in use by another job.")
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+def board_lock(key, timeout=0):
+    """
+    Holds a host-wide lock on one board for the duration of a job.
+
+    Locks are keyed by the board's USB location rather than its port name,
+    because the port disappears while the board is in DFU mode.
+
+    Parameters:
+      key (str): USB location (or port name) identifying the board.
+      timeout (float): Seconds to wait for another job to release the board.
+
+    Raises:
+      TimeoutError if the board is still locked after the timeout.
+    """
+    return host_lock(f"board_{key}", timeout)
+
+
+def read_state(path):
+    """Read a JSON state file, returning an empty dict if it is missing or unreadable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_state(path, update):
+    """
+    Read-modify-write a JSON state file under a host-wide lock.
+
+    Parameters:
+      path (str): The state file; its directory is created if needed.
+      update (callable): Called with the current contents (a dict) to modify in place.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with host_lock(f"state_{os.path.basename(path)}", STATE_LOCK_TIMEOUT):
+        state = read_state(path)
+        update(state)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)